@@ -15,6 +15,7 @@ default_config = dict(
         meta_batch=16, # number of tasks to average the gradient across
         num_iterations=500, # number of data sampling / training iterates
         num_initial_steps=2000, # number of transitions collected per task before training
+        offline_data_dir=None, # buffer snapshot or directory of task<idx>*.pkl path dumps loaded before the initial collection, which then only tops each task up to num_initial_steps
         num_tasks_sample=5, # number of randomly sampled tasks to collect data for each iteration
         num_steps_prior=400, # number of transitions to collect per task with z ~ prior
         num_steps_posterior=0, # number of transitions to collect per task with z ~ posterior
@@ -27,6 +28,24 @@ default_config = dict(
         embedding_mini_batch_size=64, # number of context transitions to backprop through (should equal the arg above except in the recurrent encoder case)
         max_path_length=200, # max path length for this environment
         discount=0.99, # RL discount factor
+        replay_buffer_dtypes=dict(), # per-column storage dtypes overriding float32 defaults, e.g. dict(observations='float16')
+        contiguous_replay_buffer=False, # preallocate one (task, size, feat) array per column so meta-batches are sampled in one gather
+        replay_buffer_backend='memory', # 'memory', 'memmap' to keep the replay buffer in np.memmap files, 'shared' for shared memory sampler processes can write to, or 'torch' to sample into reused tensors
+        replay_buffer_dir=None, # directory of the memmap files, defaults to replay_buffer/ in the log dir, point at an old run's to reopen it
+        store_next_observations=True, # False stores each observation once and rebuilds next observations from episode boundaries
+        prioritized_replay=False, # sample RL batches in proportion to TD error, the context batches stay uniform
+        priority_alpha=0.6, # exponent of the TD error priorities, 0 is uniform
+        priority_beta=0.4, # exponent of the importance sampling weights on the Q losses, 0 disables them
+        replay_buffer_budget=None, # most transitions held across all train task buffers, None lets each task hold replay_buffer_size
+        eviction_policy='oldest', # over budget, evict the oldest rows of any task ('oldest') or keep min_task_quota rows per task ('quota')
+        min_task_quota=0, # rows per task the 'quota' eviction policy never evicts
+        env_info_keys=None, # env_info keys stored as float buffer columns and sampled under their key, a list of scalar keys or a dict of key -> dim, None for the env's env_info_keys
+        prefetch_batches=0, # number of training steps whose batches are sampled ahead in a background thread, 0 samples synchronously, with prioritized_replay the priorities are then updated at the end of each iteration
+        learner_shards='shared', # with several learners, 'shared' trains all of them on one shared memory replay store (needs replay_buffer_backend='shared', no prioritized_replay) the first collects into, 'tasks' has each collect and train on its own share of the train tasks
+        ensemble_critic=False, # evaluate the Q-functions as one ensemble module with batched matmuls and a single optimizer
+        num_critics=2, # number of Q-functions in the ensemble critic, the minimum over them is used
+        compile=False, # compile the agent, critic and value network forwards with torch.compile where available, A/B step times are logged
+        precision='float32', # 'bfloat16' runs the network forwards and backwards of training steps under bfloat16 autocast, losses and weights stay float32
         soft_target_tau=0.005, # for SAC target network update
         policy_lr=3E-4,
         qf_lr=3E-4,
@@ -45,6 +64,7 @@ default_config = dict(
         base_log_dir='output',
         use_gpu=True,
         gpu_id=0,
+        num_learners=1, # number of data-parallel learner processes, each trains on meta_batch / num_learners tasks and gradients are averaged
         debug=False, # debugging triggers printing and writes logs to debug directory
         docker=False, # TODO docker is not yet supported
     )
@@ -12,16 +12,32 @@ import torch
 from rlkit.envs import ENVS
 from rlkit.envs.wrappers import NormalizedBoxEnv
 from rlkit.torch.sac.policies import TanhGaussianPolicy
-from rlkit.torch.networks import FlattenMlp, MlpEncoder, RecurrentEncoder
+from rlkit.torch.networks import FlattenMlp, EnsembleFlattenMlp, MlpEncoder, RecurrentEncoder
 from rlkit.torch.sac.sac import PEARLSoftActorCritic
 from rlkit.torch.sac.agent import PEARLAgent
 from rlkit.launchers.launcher_util import setup_logger
+from rlkit.torch import distributed
 import rlkit.torch.pytorch_util as ptu
 from configs.default import default_config
 
 
 def experiment(variant):
 
+    # debugging triggers a lot of printing and logs to a debug directory
+    DEBUG = variant['util_params']['debug']
+    os.environ['DEBUG'] = str(int(DEBUG))
+
+    # create logging directory before the algorithm, on-disk replay buffers are stored in it
+    # TODO support Docker
+    exp_id = 'debug' if DEBUG else None
+    if distributed.get_rank() == 0:
+        experiment_log_dir = setup_logger(variant['env_name'], variant=variant, exp_id=exp_id, base_log_dir=variant['util_params']['base_log_dir'])
+        distributed.broadcast_object(experiment_log_dir)
+    else:
+        # other learners keep their files in a subdirectory of the first one's
+        log_dir = os.path.join(distributed.broadcast_object(None), 'learner{}'.format(distributed.get_rank()))
+        experiment_log_dir = setup_logger(variant['env_name'], variant=variant, log_dir=log_dir)
+
     # create multi-task environment and sample tasks
     env = NormalizedBoxEnv(ENVS[variant['env_name']](**variant['env_params']))
     tasks = env.get_all_task_idx()
@@ -41,16 +57,20 @@ def experiment(variant):
         input_size=obs_dim + action_dim + reward_dim,
         output_size=context_encoder,
     )
-    qf1 = FlattenMlp(
-        hidden_sizes=[net_size, net_size, net_size],
-        input_size=obs_dim + action_dim + latent_dim,
-        output_size=1,
-    )
-    qf2 = FlattenMlp(
-        hidden_sizes=[net_size, net_size, net_size],
-        input_size=obs_dim + action_dim + latent_dim,
-        output_size=1,
-    )
+    if variant['algo_params']['ensemble_critic']:
+        # all Q-functions in one module evaluated with batched matmuls
+        qfs = [EnsembleFlattenMlp(
+            ensemble_size=variant['algo_params']['num_critics'],
+            hidden_sizes=[net_size, net_size, net_size],
+            input_size=obs_dim + action_dim + latent_dim,
+            output_size=1,
+        )]
+    else:
+        qfs = [FlattenMlp(
+            hidden_sizes=[net_size, net_size, net_size],
+            input_size=obs_dim + action_dim + latent_dim,
+            output_size=1,
+        ) for _ in range(2)]
     vf = FlattenMlp(
         hidden_sizes=[net_size, net_size, net_size],
         input_size=obs_dim + latent_dim,
@@ -72,7 +92,7 @@ def experiment(variant):
         env=env,
         train_tasks=list(tasks[:variant['n_train_tasks']]),
         eval_tasks=list(tasks[-variant['n_eval_tasks']:]),
-        nets=[agent, qf1, qf2, vf],
+        nets=[agent] + qfs + [vf],
         latent_dim=latent_dim,
         **variant['algo_params']
     )
@@ -81,8 +101,12 @@ def experiment(variant):
     if variant['path_to_weights'] is not None:
         path = variant['path_to_weights']
         context_encoder.load_state_dict(torch.load(os.path.join(path, 'context_encoder.pth')))
-        qf1.load_state_dict(torch.load(os.path.join(path, 'qf1.pth')))
-        qf2.load_state_dict(torch.load(os.path.join(path, 'qf2.pth')))
+        if variant['algo_params']['ensemble_critic']:
+            qfs[0].load_mlp_state_dicts([torch.load(os.path.join(path, 'qf{}.pth'.format(i + 1)))
+                                         for i in range(qfs[0].ensemble_size)])
+        else:
+            for i, qf in enumerate(qfs):
+                qf.load_state_dict(torch.load(os.path.join(path, 'qf{}.pth'.format(i + 1))))
         vf.load_state_dict(torch.load(os.path.join(path, 'vf.pth')))
         # TODO hacky, revisit after model refactor
         algorithm.networks[-2].load_state_dict(torch.load(os.path.join(path, 'target_vf.pth')))
@@ -93,15 +117,6 @@ def experiment(variant):
     if ptu.gpu_enabled():
         algorithm.to()
 
-    # debugging triggers a lot of printing and logs to a debug directory
-    DEBUG = variant['util_params']['debug']
-    os.environ['DEBUG'] = str(int(DEBUG))
-
-    # create logging directory
-    # TODO support Docker
-    exp_id = 'debug' if DEBUG else None
-    experiment_log_dir = setup_logger(variant['env_name'], variant=variant, exp_id=exp_id, base_log_dir=variant['util_params']['base_log_dir'])
-
     # optionally save eval trajectories as pkl files
     if variant['algo_params']['dump_eval_paths']:
         pickle_dir = experiment_log_dir + '/eval_trajectories'
@@ -112,9 +127,9 @@ def experiment(variant):
 
 def deep_update_dict(fr, to):
     ''' update dict of dicts with new values '''
-    # assume dicts have same keys
+    # assume dicts have same keys, dicts replacing non-dict defaults (e.g. None) are set as a whole
     for k, v in fr.items():
-        if type(v) is dict:
+        if type(v) is dict and type(to.get(k)) is dict:
             deep_update_dict(v, to[k])
         else:
             to[k] = v
@@ -134,7 +149,12 @@ def main(config, gpu, docker, debug):
         variant = deep_update_dict(exp_params, variant)
     variant['util_params']['gpu_id'] = gpu
 
-    experiment(variant)
+    num_learners = variant['util_params']['num_learners']
+    if num_learners > 1:
+        # data-parallel learners, one process each
+        distributed.spawn_learners(experiment, num_learners, variant)
+    else:
+        experiment(variant)
 
 if __name__ == "__main__":
     main()
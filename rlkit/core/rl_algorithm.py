@@ -1,15 +1,23 @@
 import abc
 from collections import OrderedDict
+import os
 import time
 
 import gtimer as gt
 import numpy as np
 
 from rlkit.core import logger, eval_util
-from rlkit.data_management.env_replay_buffer import MultiTaskReplayBuffer
+from rlkit.data_management.buffer_snapshot import BufferSnapshotWriter
+from rlkit.data_management.env_replay_buffer import MultiTaskReplayBuffer, MultiTaskReplayBufferView
+from rlkit.data_management.offline_data import load_offline_data
 from rlkit.data_management.path_builder import PathBuilder
+from rlkit.data_management.prefetcher import BatchPrefetcher
+from rlkit.data_management.sampling_plan import SamplingPlan
+from rlkit.data_management.shared_storage import SharedStorage
 from rlkit.samplers.in_place import InPlacePathSampler
+from rlkit.torch import distributed
 from rlkit.torch import pytorch_util as ptu
+from rlkit.torch.data_management.replay_buffer import TorchMultiTaskReplayBuffer, TorchMultiTaskReplayBufferView
 
 
 class MetaRLAlgorithm(metaclass=abc.ABCMeta):
@@ -23,6 +31,7 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
             num_iterations=100,
             num_train_steps_per_itr=1000,
             num_initial_steps=100,
+            offline_data_dir=None,
             num_tasks_sample=100,
             num_steps_prior=100,
             num_steps_posterior=100,
@@ -35,6 +44,20 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
             max_path_length=1000,
             discount=0.99,
             replay_buffer_size=1000000,
+            replay_buffer_dtypes=None,
+            contiguous_replay_buffer=False,
+            replay_buffer_backend='memory',
+            replay_buffer_dir=None,
+            store_next_observations=True,
+            prioritized_replay=False,
+            priority_alpha=0.6,
+            priority_beta=0.4,
+            replay_buffer_budget=None,
+            eviction_policy='oldest',
+            min_task_quota=0,
+            env_info_keys=None,
+            prefetch_batches=0,
+            learner_shards='shared',
             reward_scale=1,
             num_exp_traj_eval=1,
             update_post_train=1,
@@ -61,9 +84,11 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         self.train_tasks = train_tasks
         self.eval_tasks = eval_tasks
         self.meta_batch = meta_batch
+        self.local_tasks = train_tasks
         self.num_iterations = num_iterations
         self.num_train_steps_per_itr = num_train_steps_per_itr
         self.num_initial_steps = num_initial_steps
+        self.offline_data_dir = offline_data_dir
         self.num_tasks_sample = num_tasks_sample
         self.num_steps_prior = num_steps_prior
         self.num_steps_posterior = num_steps_posterior
@@ -76,12 +101,63 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         self.max_path_length = max_path_length
         self.discount = discount
         self.replay_buffer_size = replay_buffer_size
+        self.replay_buffer_dtypes = replay_buffer_dtypes
+        self.contiguous_replay_buffer = contiguous_replay_buffer
+        self.replay_buffer_backend = replay_buffer_backend
+        if replay_buffer_backend == 'memmap' and replay_buffer_dir is None:
+            replay_buffer_dir = os.path.join(logger.get_snapshot_dir(), 'replay_buffer')
+        self.replay_buffer_dir = replay_buffer_dir
+        self.store_next_observations = store_next_observations
+        self.prioritized_replay = prioritized_replay
+        self.priority_alpha = priority_alpha
+        self.priority_beta = priority_beta
+        self.replay_buffer_budget = replay_buffer_budget
+        self.eviction_policy = eviction_policy
+        self.min_task_quota = min_task_quota
+        self.env_info_keys = env_info_keys
+        self.prefetch_batches = prefetch_batches
         self.reward_scale = reward_scale
+
+        # data-parallel learners, see rlkit.torch.distributed
+        # each learner trains on meta_batch / num_learners tasks of every meta-batch, and all
+        # learners average their gradients, either reading one replay store in shared memory
+        # that the first learner collects data into ('shared'), or each collecting data for
+        # and training on its own share of the train tasks ('tasks')
+        self.learner_rank = distributed.get_rank()
+        self.num_learners = distributed.get_world_size()
+        if learner_shards not in ['shared', 'tasks']:
+            raise ValueError("Unknown learner shards: {}".format(learner_shards))
+        self.learner_shards = learner_shards
+        self._num_tasks_sample_local = num_tasks_sample
+        self._reads_shared_store = False
+        if self.num_learners > 1:
+            if meta_batch % self.num_learners != 0:
+                raise ValueError("meta_batch {} is not divisible by the {} learners".format(meta_batch, self.num_learners))
+            self.meta_batch = meta_batch // self.num_learners
+            if learner_shards == 'shared':
+                if replay_buffer_backend != 'shared':
+                    raise ValueError("learner_shards='shared' needs replay_buffer_backend='shared'")
+                if prioritized_replay:
+                    # learners reading the store restore its bookkeeping every iteration, which resets
+                    # their priorities, and the first learner's would only see its own TD errors
+                    raise ValueError("learner_shards='shared' does not support prioritized_replay, use 'tasks'")
+                self._reads_shared_store = self.learner_rank > 0
+            else:
+                if len(train_tasks) < self.num_learners:
+                    raise ValueError("{} train tasks cannot be split between {} learners".format(
+                        len(train_tasks), self.num_learners))
+                self.local_tasks = distributed.shard(train_tasks)
+                self._num_tasks_sample_local = len(distributed.shard(range(num_tasks_sample)))
+
         self.update_post_train = update_post_train
         self.num_exp_traj_eval = num_exp_traj_eval
         self.eval_deterministic = eval_deterministic
         self.render = render
         self.save_replay_buffer = save_replay_buffer
+        self._buffer_snapshot = None
+        if save_replay_buffer and not self._reads_shared_store:
+            # append-only chunks of the rows added since the previous save, see load_buffer_snapshot
+            self._buffer_snapshot = BufferSnapshotWriter(os.path.join(logger.get_snapshot_dir(), 'replay_buffer_snapshot'))
         self.save_algorithm = save_algorithm
         self.save_environment = save_environment
 
@@ -99,17 +175,42 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         # separate replay buffers for
         # - training RL update
         # - training encoder update
-        self.replay_buffer = MultiTaskReplayBuffer(
-                self.replay_buffer_size,
-                env,
-                self.train_tasks,
-            )
-
-        self.enc_replay_buffer = MultiTaskReplayBuffer(
-                self.replay_buffer_size,
-                env,
-                self.train_tasks,
+        # the encoder buffer is a view over the rows of the RL buffer, so shared data is stored once
+        buffer_kwargs = dict(
+            dtypes=self.replay_buffer_dtypes,
+            store_next_observations=self.store_next_observations,
+            prioritized=self.prioritized_replay,
+            priority_alpha=self.priority_alpha,
+            global_budget=self.replay_buffer_budget,
+            eviction_policy=self.eviction_policy,
+            min_task_quota=self.min_task_quota,
+            env_info_keys=self.env_info_keys,
         )
+        if self.replay_buffer_backend == 'torch':
+            # torch tensor storage, meta-batches are sampled straight into reused tensors
+            self.replay_buffer = TorchMultiTaskReplayBuffer(
+                    self.replay_buffer_size,
+                    env,
+                    self.local_tasks,
+                    **buffer_kwargs
+                )
+            self.enc_replay_buffer = TorchMultiTaskReplayBufferView(self.replay_buffer)
+        else:
+            if self._reads_shared_store:
+                # attach to the shared memory of the first learner's buffer
+                buffer_kwargs['shared_storage'] = SharedStorage.attach_reader(distributed.broadcast_object(None))
+            self.replay_buffer = MultiTaskReplayBuffer(
+                    self.replay_buffer_size,
+                    env,
+                    self.local_tasks,
+                    contiguous=self.contiguous_replay_buffer,
+                    backend=self.replay_buffer_backend,
+                    storage_dir=self.replay_buffer_dir,
+                    **buffer_kwargs
+                )
+            self.enc_replay_buffer = MultiTaskReplayBufferView(self.replay_buffer)
+            if self.num_learners > 1 and self.learner_shards == 'shared' and self.learner_rank == 0:
+                distributed.broadcast_object(self.replay_buffer.shared_storage.reader_state())
 
         self._n_env_steps_total = 0
         self._n_train_steps_total = 0
@@ -118,6 +219,11 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         self._epoch_start_time = None
         self._algo_start_time = None
         self._old_table_keys = None
+        self._prefetch_statistics = None
+        self._training_statistics = OrderedDict()
+        self._sampling_plan_seed = None
+        # priority updates held back while a prefetcher samples from the buffers
+        self._deferred_priorities = None
         self._current_path_builder = PathBuilder()
         self._exploration_paths = []
 
@@ -141,6 +247,9 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         '''
         meta-training loop
         '''
+        if self.num_learners > 1:
+            # learners start from the same parameters and stay in sync by averaging gradients
+            distributed.broadcast_parameters(self.networks)
         self.pretrain()
         params = self.get_epoch_snapshot(-1)
         logger.save_itr_params(-1, params)
@@ -155,19 +264,26 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         ):
             self._start_epoch(it_)
             self.training_mode(True)
-            if it_ == 0:
+            if it_ == 0 and not self._reads_shared_store:
+                loaded = dict()
+                if self.offline_data_dir is not None:
+                    print('loading initial pool of data from {}'.format(self.offline_data_dir))
+                    loaded = load_offline_data(self.offline_data_dir, self.replay_buffer, self.enc_replay_buffer,
+                                               sparse_rewards=self.sparse_rewards)
                 print('collecting initial pool of data for train and eval')
                 # temp for evaluating
-                for idx in self.train_tasks:
+                for idx in self.local_tasks:
                     self.task_idx = idx
                     self.env.reset_task(idx)
-                    self.collect_data(self.num_initial_steps, 1, np.inf)
+                    # loaded transitions count towards the initial pool
+                    self.collect_data(max(self.num_initial_steps - loaded.get(idx, 0), 0), 1, np.inf)
             # Sample data from train tasks.
-            for i in range(self.num_tasks_sample):
-                idx = np.random.randint(len(self.train_tasks))
+            # learners reading the shared store leave collection to the first learner
+            for i in range(0 if self._reads_shared_store else self._num_tasks_sample_local):
+                idx = self.local_tasks[np.random.randint(len(self.local_tasks))]
                 self.task_idx = idx
                 self.env.reset_task(idx)
-                self.enc_replay_buffer.task_buffers[idx].clear()
+                self.enc_replay_buffer.clear_buffer(idx)
 
                 # collect some trajectories with z ~ prior
                 if self.num_steps_prior > 0:
@@ -180,10 +296,40 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
                     self.collect_data(self.num_extra_rl_steps_posterior, 1, self.update_post_train, add_to_enc_buffer=False)
 
             # Sample train tasks and compute gradient updates on parameters.
-            for train_step in range(self.num_train_steps_per_itr):
-                indices = np.random.choice(self.train_tasks, self.meta_batch)
-                self._do_training(indices)
-                self._n_train_steps_total += 1
+            # the tasks and transitions of every step are drawn up front by a plan seeded from
+            # the global RNG, so seeded runs are reproducible and the logged seed replays the batches
+            # every learner draws its share of the meta-batch from its own plan, seeded by its rank,
+            # which as tasks are drawn with replacement is the same as splitting one meta-batch
+            self._sampling_plan_seed = self._sync_learners(np.random.randint(2 ** 31))
+            plan = SamplingPlan(self.local_tasks, self.num_train_steps_per_itr, self.meta_batch,
+                                self.training_draw_shapes(), seed=self._sampling_plan_seed + self.learner_rank)
+            prefetcher = None
+            if self.prefetch_batches > 0:
+                # batches for the next steps are sampled in the background while the current one trains
+                # the buffers must not change meanwhile, so priority updates wait until training ends,
+                # i.e. batches of an iteration are sampled by the priorities at its start
+                self._deferred_priorities = []
+                prefetcher = BatchPrefetcher(lambda: self._sample_train_step(plan), self.num_train_steps_per_itr,
+                                             max_prefetch=self.prefetch_batches)
+            try:
+                for train_step in range(self.num_train_steps_per_itr):
+                    if prefetcher is None:
+                        indices, draws = plan.next_step()
+                        batches = self.sample_training_batches(indices, draws, reuse=True)
+                    else:
+                        indices, batches = prefetcher.get()
+                    self._do_training(indices, batches)
+                    self._n_train_steps_total += 1
+            finally:
+                if prefetcher is not None:
+                    prefetcher.close()
+            if prefetcher is not None:
+                self._prefetch_statistics = prefetcher.get_diagnostics()
+                deferred, self._deferred_priorities = self._deferred_priorities, None
+                for update in deferred:
+                    self.replay_buffer.update_priorities_multi(*update)
+            # read once per iteration, so the stats cover the steps of the iteration they are logged with
+            self._training_statistics = self.get_training_diagnostics()
             gt.stamp('train')
 
             self.training_mode(False)
@@ -200,6 +346,31 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         """
         pass
 
+    def update_priorities(self, indices, rows, td_errors):
+        ''' update the priorities of sampled rows, see MultiTaskReplayBuffer.update_priorities_multi '''
+        if self._deferred_priorities is not None:
+            # a prefetcher is sampling, applied in order once it stops
+            self._deferred_priorities.append((indices, rows, td_errors))
+        else:
+            self.replay_buffer.update_priorities_multi(indices, rows, td_errors)
+
+    def _sync_learners(self, seed):
+        '''
+        the first learner's seed for the sampling plans of this iteration
+        learners reading the shared store also take on the bookkeeping of the rows the first
+        one collected, they do not read the store while it collects
+        '''
+        if self.num_learners == 1:
+            return seed
+        state = None
+        if self.learner_shards == 'shared' and self.learner_rank == 0:
+            state = (self.replay_buffer.get_state(), self.enc_replay_buffer.get_state())
+        seed, state = distributed.broadcast_object((seed, state))
+        if self._reads_shared_store:
+            self.replay_buffer.set_state(state[0])
+            self.enc_replay_buffer.set_state(state[1])
+        return seed
+
     def collect_data(self, num_samples, resample_z_rate, update_posterior_rate, add_to_enc_buffer=True):
         '''
         get trajectories from current env in batch mode with given policy
@@ -221,9 +392,9 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
                                                                 accum_context=False,
                                                                 resample=resample_z_rate)
             num_transitions += n_samples
-            self.replay_buffer.add_paths(self.task_idx, paths)
+            ranges = self.replay_buffer.add_paths(self.task_idx, paths)
             if add_to_enc_buffer:
-                self.enc_replay_buffer.add_paths(self.task_idx, paths)
+                self.enc_replay_buffer.add_ranges(self.task_idx, ranges)
             if update_posterior_rate != np.inf:
                 context = self.prepare_context(self.task_idx)
                 self.agent.infer_posterior(context)
@@ -232,6 +403,10 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
 
     def _try_to_eval(self, epoch):
         logger.save_extra_data(self.get_extra_data_to_save(epoch))
+        # on-disk buffers are reopened from their own files rather than pickled
+        self.replay_buffer.flush()
+        if self._buffer_snapshot is not None:
+            self._buffer_snapshot.write(self.replay_buffer)
         if self._can_evaluate():
             self.evaluate(epoch)
 
@@ -288,10 +463,11 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         :return:
         """
         # eval collects its own context, so can eval any time
-        return True
+        # with several learners, the first one evaluates and logs
+        return self.learner_rank == 0
 
     def _can_train(self):
-        return all([self.replay_buffer.num_steps_can_sample(idx) >= self.batch_size for idx in self.train_tasks])
+        return all([self.replay_buffer.num_steps_can_sample(idx) >= self.batch_size for idx in self.local_tasks])
 
     def _get_action_and_info(self, agent, observation):
         """
@@ -339,8 +515,6 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         )
         if self.save_environment:
             data_to_save['env'] = self.training_env
-        if self.save_replay_buffer:
-            data_to_save['replay_buffer'] = self.replay_buffer
         if self.save_algorithm:
             data_to_save['algorithm'] = self
         return data_to_save
@@ -363,7 +537,9 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
 
         if self.sparse_rewards:
             for p in paths:
-                sparse_rewards = np.stack(e['sparse_reward'] for e in p['env_infos']).reshape(-1, 1)
+                sparse_rewards = np.stack([e['sparse_reward'] for e in p['env_infos']]).reshape(-1, 1)
+                # dumped paths keep the dense rewards, which load_offline_data adds to the buffer
+                p['dense_rewards'] = p['rewards']
                 p['rewards'] = sparse_rewards
 
         goal = self.env._goal
@@ -406,7 +582,7 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
 
         ### train tasks
         # eval on a subset of train tasks for speed
-        indices = np.random.choice(self.train_tasks, len(self.eval_tasks))
+        indices = np.random.choice(self.local_tasks, len(self.eval_tasks))
         eval_util.dprint('evaluating on {} train tasks'.format(len(indices)))
         ### eval train tasks with posterior sampled from the training replay buffer
         train_returns = []
@@ -425,7 +601,7 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
 
             if self.sparse_rewards:
                 for p in paths:
-                    sparse_rewards = np.stack(e['sparse_reward'] for e in p['env_infos']).reshape(-1, 1)
+                    sparse_rewards = np.stack([e['sparse_reward'] for e in p['env_infos']]).reshape(-1, 1)
                     p['rewards'] = sparse_rewards
 
             train_returns.append(eval_util.get_average_returns(paths))
@@ -460,6 +636,14 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         for key, value in self.eval_statistics.items():
             logger.record_tabular(key, value)
         self.eval_statistics = None
+        logger.record_tabular('Sampling Plan Seed', self._sampling_plan_seed)
+        for key, value in self.replay_buffer.get_diagnostics().items():
+            logger.record_tabular(key, value)
+        if self._prefetch_statistics is not None:
+            for key, value in self._prefetch_statistics.items():
+                logger.record_tabular(key, value)
+        for key, value in self._training_statistics.items():
+            logger.record_tabular(key, value)
 
         if self.render_eval_paths:
             self.env.render_paths(paths)
@@ -476,10 +660,43 @@ class MetaRLAlgorithm(metaclass=abc.ABCMeta):
         """
         pass
 
+    def get_training_diagnostics(self):
+        """
+        Stats accumulated over the training steps of an iteration, read once after them.
+        :return: OrderedDict of name -> value
+        """
+        return OrderedDict()
+
+    def _sample_train_step(self, plan):
+        ''' task indices and batches of the next training step of plan '''
+        indices, draws = plan.next_step()
+        return indices, self.sample_training_batches(indices, draws)
+
+    @abc.abstractmethod
+    def training_draw_shapes(self):
+        """
+        Shapes of the draws in [0, 1) one training step takes from the SamplingPlan.
+        :return: dict of name -> shape
+        """
+        pass
+
+    @abc.abstractmethod
+    def sample_training_batches(self, indices, draws, reuse=False):
+        """
+        Sample every batch one _do_training call needs.
+        :param indices: task indices of the meta-batch
+        :param draws: dict of name -> draws of this step, see training_draw_shapes
+        :param reuse: batches may share storage with the next call's, i.e. are not prefetched
+        :return: batches, passed on to _do_training
+        """
+        pass
+
     @abc.abstractmethod
-    def _do_training(self):
+    def _do_training(self, indices, batches):
         """
         Perform some update, e.g. perform one gradient step.
+        :param indices: task indices of the meta-batch
+        :param batches: output of sample_training_batches
         :return:
         """
         pass
@@ -0,0 +1,119 @@
+"""
+Append-only snapshots of a MultiTaskReplayBuffer: each write stores only the rows
+added to each task since the previous one, as a (compressed) .npz chunk, and a JSON
+manifest lists the chunks that still hold live rows.
+"""
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _write_json(file_name, data):
+    with open(file_name + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def read_manifest(directory):
+    with open(osp.join(directory, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+class BufferSnapshotWriter(object):
+    """
+    Writes snapshots of a MultiTaskReplayBuffer to directory.
+
+    Chunk files are never rewritten. The manifest is replaced atomically after the
+    new chunks are on disk, so an interrupted write leaves the previous snapshot
+    intact. Chunks whose rows have all been overwritten are dropped.
+    """
+
+    def __init__(self, directory, compress=True):
+        self._directory = directory
+        self._save = np.savez_compressed if compress else np.savez
+        # per task: chunks in the manifest and the absolute row saved up to
+        self._chunks = dict()
+        self._saved = dict()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, replay_buffer):
+        ''' add the rows written to replay_buffer since the last call and update the manifest '''
+        stale = []
+        tasks = []
+        for task, buf in replay_buffer.task_buffers.items():
+            chunks = self._chunks.setdefault(task, [])
+            if buf.num_added() < self._saved.get(task, 0):
+                # the task buffer was cleared since the last snapshot
+                stale += chunks
+                chunks = self._chunks[task] = []
+                self._saved[task] = 0
+            oldest = buf.oldest_absolute_row()
+            start, end = max(self._saved.get(task, 0), oldest), buf.num_added()
+            if end > start:
+                columns, starts, lengths, final_obs = buf.export_rows(start, end)
+                arrays = dict(columns, episode_starts=starts, episode_lengths=lengths)
+                if final_obs is not None:
+                    arrays['episode_final_obs'] = final_obs
+                file_name = 'task{}_{:012d}.npz'.format(task, start)
+                self._save(osp.join(self._directory, file_name), **arrays)
+                chunks.append(dict(file=file_name, start=int(start), length=int(end - start)))
+            self._saved[task] = end
+            stale += [chunk for chunk in chunks if chunk['start'] + chunk['length'] <= oldest]
+            chunks[:] = [chunk for chunk in chunks if chunk['start'] + chunk['length'] > oldest]
+            tasks.append([task, dict(chunks=chunks, oldest=int(oldest), num_added=int(end))])
+        _write_json(osp.join(self._directory, MANIFEST_FILE), dict(tasks=tasks))
+        for chunk in stale:
+            os.remove(osp.join(self._directory, chunk['file']))
+
+
+def load_buffer_snapshot(directory, replay_buffer, tasks=None):
+    '''
+    add the rows of a snapshot to replay_buffer in bulk, one add_columns call per chunk
+    :param replay_buffer: MultiTaskReplayBuffer holding the snapshot's tasks
+    :param tasks: only load these tasks, all by default
+    :return: dict of task -> (absolute start, length) of the loaded episodes,
+        e.g. for MultiTaskReplayBufferView.add_ranges
+    '''
+    manifest = read_manifest(directory)
+    ranges = dict()
+    for task, entry in manifest['tasks']:
+        if tasks is not None and task not in tasks:
+            continue
+        buf = replay_buffer.task_buffers[task]
+        ranges[task] = []
+        previous_end = None
+        for chunk in entry['chunks']:
+            # rows that were overwritten when the snapshot was written are skipped
+            skip = max(0, entry['oldest'] - chunk['start'])
+            with np.load(osp.join(directory, chunk['file'])) as data:
+                missing = set(buf._storage_attrs()) - set(data.keys())
+                if missing:
+                    raise ValueError("Snapshot {} has no columns {}, store_next_observations=False "
+                                     "can load snapshots without next observations".format(
+                                         chunk['file'], sorted(missing)))
+                columns = dict([(attr, data[attr][skip:]) for attr in buf._storage_attrs()])
+                starts = data['episode_starts'] - skip
+                lengths = data['episode_lengths']
+                if 'episode_final_obs' in data.keys():
+                    final_obs = data['episode_final_obs']
+                else:
+                    final_obs = data['_next_obs'][data['episode_starts'] + lengths - 1]
+            # drop episodes that ended in skipped rows, episodes that began before the chunk are
+            # partly overwritten unless the rows before it were just loaded
+            keep = starts + lengths > 0
+            starts, lengths, final_obs = starts[keep], lengths[keep], final_obs[keep]
+            if previous_end != chunk['start'] or skip > 0:
+                # like partly overwritten episodes of a live buffer, they keep their rows and final
+                # observation but start before the oldest row, so they are not sampled as sequences
+                ends = starts + lengths
+                before_oldest = buf.oldest_absolute_row() - buf.num_added() - 1
+                starts = np.where(starts < 0, np.minimum(starts, before_oldest), starts)
+                lengths = ends - starts
+            ranges[task] += replay_buffer.add_columns(task, columns, starts, lengths, final_obs)
+            previous_end = chunk['start'] + chunk['length']
+    return ranges
@@ -1,6 +1,15 @@
+from collections import OrderedDict, deque
+
 import numpy as np
 
-from rlkit.data_management.simple_replay_buffer import SimpleReplayBuffer
+from rlkit.core.eval_util import create_stats_ordered_dict
+from rlkit.data_management.eviction import make_eviction_policy
+from rlkit.data_management.memmap_storage import open_memmap_storage, save_buffer_state, load_buffer_state
+from rlkit.data_management.running_stats import RunningStats
+from rlkit.data_management.shared_storage import SharedStorage
+from rlkit.data_management.simple_replay_buffer import (
+    SimpleReplayBuffer, SimpleReplayBufferView, storage_layout, batch_keys, SAMPLE_DTYPE,
+)
 from gym.spaces import Box, Discrete, Tuple
 
 
@@ -10,30 +19,240 @@ class MultiTaskReplayBuffer(object):
             max_replay_buffer_size,
             env,
             tasks,
+            dtypes=None,
+            contiguous=False,
+            backend='memory',
+            storage_dir=None,
+            store_next_observations=True,
+            prioritized=False,
+            priority_alpha=0.6,
+            global_budget=None,
+            eviction_policy='oldest',
+            min_task_quota=0,
+            env_info_keys=None,
+            shared_storage=None,
     ):
         """
         :param max_replay_buffer_size:
         :param env:
         :param tasks: for multi-task setting
+        :param dtypes: optional dict of per-column storage dtypes, see SimpleReplayBuffer
+        :param contiguous: back all task buffers by one (num_tasks, max_replay_buffer_size, feat)
+            array per column so random_batch_multi is a single gather, storage is then
+            preallocated rather than grown per task
+        :param backend: 'memory' for numpy arrays, 'memmap' for np.memmap files in storage_dir,
+            'shared' for contiguous shared memory sampler processes can write to, see ingest_shared
+        :param storage_dir: directory of the memmap files, existing files and state are reopened
+        :param store_next_observations: if False, next observations are rebuilt from the
+            observation stream when sampling rather than stored, see SimpleReplayBuffer
+        :param prioritized: sample transitions in proportion to their TD error from a SumTree
+            per task, see update_priorities_multi
+        :param priority_alpha: exponent applied to the TD errors, 0 samples uniformly
+        :param global_budget: most transitions held by all task buffers together, rows are
+            evicted by eviction_policy when a write goes over it, None for no limit
+            rows a view (e.g. the encoder buffer) still references are never evicted, so
+            while they fill the budget the buffer holds more
+        :param eviction_policy: 'oldest' to evict the oldest rows of any task, 'quota' to do so
+            while keeping min_task_quota rows per task, or a policy object, see eviction.py
+        :param env_info_keys: env_info values stored as columns, see SimpleReplayBuffer,
+            defaults to the env's env_info_keys attribute
+        :param shared_storage: with backend='shared', an existing SharedStorage to use rather
+            than creating one, e.g. a reader attached to another process's, see set_state
         """
         self.env = env
         self._ob_space = env.observation_space
         self._action_space = env.action_space
+        observation_dim = get_dim(self._ob_space)
+        action_dim = get_dim(self._action_space)
+        if env_info_keys is None:
+            env_info_keys = getattr(env, 'env_info_keys', None)
+        layout = storage_layout(observation_dim, action_dim, dtypes, store_next_observations, env_info_keys)
+        self._batch_keys = batch_keys(layout)
+        self._prioritized = prioritized
+        self._max_replay_buffer_size = max_replay_buffer_size
+        self._task_rows = dict([(idx, row) for row, idx in enumerate(tasks)])
+        self._storage_dir = storage_dir if backend == 'memmap' else None
+        self.shared_storage = None
+        if backend == 'shared':
+            if shared_storage is None:
+                shared_storage = SharedStorage(tasks, max_replay_buffer_size, layout)
+            self.shared_storage = shared_storage
+            self._storage = self.shared_storage.arrays
+            task_storage = dict([(idx, self.shared_storage.task_arrays(idx)) for idx in tasks])
+        elif backend == 'memmap':
+            self._storage, task_storage = open_memmap_storage(
+                storage_dir, tasks, max_replay_buffer_size, layout, contiguous=contiguous)
+        elif backend == 'memory':
+            self._storage, task_storage = None, dict([(idx, None) for idx in tasks])
+            if contiguous:
+                self._storage = self._allocate_contiguous(layout, len(tasks), max_replay_buffer_size)
+                task_storage = dict([
+                    (idx, dict([(attr, array[row]) for attr, array in self._storage.items()]))
+                    for idx, row in self._task_rows.items()
+                ])
+        else:
+            raise ValueError("Unknown replay buffer backend: {}".format(backend))
         self.task_buffers = dict([(idx, SimpleReplayBuffer(
             max_replay_buffer_size=max_replay_buffer_size,
-            observation_dim=get_dim(self._ob_space),
-            action_dim=get_dim(self._action_space),
+            observation_dim=observation_dim,
+            action_dim=action_dim,
+            dtypes=dtypes,
+            storage=task_storage[idx],
+            store_next_observations=store_next_observations,
+            prioritized=prioritized,
+            priority_alpha=priority_alpha,
+            env_info_keys=env_info_keys,
         )) for idx in tasks])
+        if backend == 'memmap':
+            states = load_buffer_state(storage_dir)
+            if states is not None:
+                self.set_state(states)
+        self._global_budget = global_budget
+        if isinstance(eviction_policy, str):
+            eviction_policy = make_eviction_policy(eviction_policy, min_task_quota)
+        self._eviction_policy = eviction_policy
+        self._num_evicted = 0
+        # views over the buffer, whose rows are kept from eviction
+        self._views = []
+        # with a budget, the live writes of each task as [global start, length], oldest first
+        # rows reopened from disk count as written at the same time
+        self._chunks = dict([(idx, deque()) for idx in tasks])
+        self._chunk_rows = dict([(idx, 0) for idx in tasks])
+        self._num_added_global = 0
+        self._last_write_task = None
+        for idx, buf in self.task_buffers.items():
+            if buf.size() > 0:
+                self._chunks[idx].append([0, buf.size()])
+                self._chunk_rows[idx] = buf.size()
+        self._num_added_global = sum(self._chunk_rows.values())
+        # shared backend: write records waiting for earlier writes, by task and start, and
+        # episodes applied but not yet returned by ingest_shared
+        self._pending = dict([(idx, dict()) for idx in tasks])
+        self._ingested = dict([(idx, []) for idx in tasks])
+
+    def _allocate_contiguous(self, layout, num_tasks, max_replay_buffer_size):
+        ''' in-memory (num_tasks, max_replay_buffer_size, feat) array for every storage attribute '''
+        return dict([
+            (attr, np.zeros((num_tasks, max_replay_buffer_size) + shape, dtype=dtype))
+            for attr, (shape, dtype) in layout.items()
+        ])
+
+    def _record_write(self, task, num_rows):
+        ''' track the age of rows written to a task and evict rows if the budget is exceeded '''
+        if self._global_budget is None:
+            return
+        chunks = self._chunks[task]
+        if (self._last_write_task == task and len(chunks)
+                and chunks[-1][0] + chunks[-1][1] == self._num_added_global):
+            chunks[-1][1] += num_rows
+        else:
+            chunks.append([self._num_added_global, num_rows])
+        self._chunk_rows[task] += num_rows
+        self._last_write_task = task
+        self._num_added_global += num_rows
+        # the task's own ring buffer may have overwritten some of its rows
+        self._trim_chunks(task)
+        total = sum(buf.size() for buf in self.task_buffers.values())
+        if total > self._global_budget:
+            limits = dict([(idx, self._evictable_rows(idx)) for idx in self.task_buffers])
+            # the rows just written are yet to be added to the views
+            limits[task] = min(limits[task], max(self.task_buffers[task].size() - num_rows, 0))
+            counts = self._eviction_policy.select(self._chunks, total - self._global_budget, limits)
+            for idx, count in counts.items():
+                if count > 0:
+                    self.task_buffers[idx].evict_oldest(count)
+                    self._trim_chunks(idx)
+                    self._num_evicted += count
+
+    def add_view(self, view):
+        ''' keep the rows view references from eviction, see MultiTaskReplayBufferView '''
+        self._views.append(view)
+
+    def _evictable_rows(self, task):
+        ''' number of oldest rows of a task before the first row any view references '''
+        buf = self.task_buffers[task]
+        count = buf.size()
+        for view in self._views:
+            first = view.task_buffers[task].first_referenced_row()
+            if first is not None:
+                count = min(count, first - buf.oldest_absolute_row())
+        return count
+
+    def _trim_chunks(self, task):
+        ''' drop the oldest chunk rows until they match the rows the task buffer holds '''
+        chunks = self._chunks[task]
+        excess = self._chunk_rows[task] - self.task_buffers[task].size()
+        while excess > 0:
+            count = min(excess, chunks[0][1])
+            chunks[0][0] += count
+            chunks[0][1] -= count
+            self._chunk_rows[task] -= count
+            excess -= count
+            if chunks[0][1] == 0:
+                chunks.popleft()
+
+    def task_sizes(self):
+        ''' number of transitions held for each task '''
+        return dict([(idx, buf.size()) for idx, buf in self.task_buffers.items()])
+
+    def stats(self, tasks=None):
+        '''
+        batch key -> RunningStats over the rows written to tasks, all by default,
+        merged from the task buffers' running stats, see SimpleReplayBuffer.stats
+        '''
+        buffers = [self.task_buffers[task] for task in (self.task_buffers if tasks is None else tasks)]
+        return dict([
+            (key, RunningStats.combine(buf.stats()[key] for buf in buffers)) for key in buffers[0].stats()
+        ])
+
+    def get_diagnostics(self):
+        ''' total and per-task occupancy of the buffer and the reward stats '''
+        sizes = list(self.task_sizes().values())
+        stats = OrderedDict([('Replay Buffer Size', sum(sizes))])
+        rewards = self.stats()['rewards']
+        stats['Replay Buffer Rewards Mean'] = rewards.mean[0]
+        stats['Replay Buffer Rewards Std'] = rewards.std[0]
+        stats.update(create_stats_ordered_dict('Replay Buffer Task Size', sizes))
+        if self._global_budget is not None:
+            stats['Replay Buffer Budget Usage'] = sum(sizes) / self._global_budget
+            stats['Replay Buffer Evicted'] = self._num_evicted
+        return stats
+
+    def flush(self):
+        ''' write memmap columns and buffer state to disk so the buffer can be reopened '''
+        if self._storage_dir is None:
+            return
+        if self._storage is not None:
+            arrays = list(self._storage.values())
+        else:
+            arrays = [getattr(buf, attr) for buf in self.task_buffers.values() for attr in buf._storage_attrs()]
+        for array in arrays:
+            array.flush()
+        save_buffer_state(self._storage_dir, self.get_state())
 
+    def get_state(self):
+        ''' bookkeeping of every task buffer, see SimpleReplayBuffer.get_state '''
+        return dict([(idx, buf.get_state()) for idx, buf in self.task_buffers.items()])
+
+    def set_state(self, states):
+        '''
+        restore the bookkeeping of task buffers whose storage already holds the rows, e.g.
+        reopened memmap files or shared memory another process writes to
+        '''
+        for idx, state in states.items():
+            self.task_buffers[idx].set_state(state)
 
     def add_sample(self, task, observation, action, reward, terminal,
             next_observation, **kwargs):
+        if self.shared_storage is not None:
+            raise NotImplementedError("The shared replay buffer backend only takes complete paths")
 
         if isinstance(self._action_space, Discrete):
             action = np.eye(self._action_space.n)[action]
         self.task_buffers[task].add_sample(
                 observation, action, reward, terminal,
                 next_observation, **kwargs)
+        self._record_write(task, 1)
 
     def terminate_episode(self, task):
         self.task_buffers[task].terminate_episode()
@@ -45,18 +264,179 @@ class MultiTaskReplayBuffer(object):
             batch = self.task_buffers[task].random_batch(batch_size)
         return batch
 
+    def rows_from_uniform_multi(self, tasks, uniform, sequence=False):
+        ''' (task, batch) storage rows selected by (task, batch) draws in [0, 1), see SamplingPlan '''
+        if sequence or self._prioritized:
+            return np.stack([self.task_buffers[task].rows_from_uniform(task_uniform, sequence=sequence)
+                             for task, task_uniform in zip(tasks, uniform)])
+        sizes = np.array([self.task_buffers[task].size() for task in tasks])
+        oldest = np.array([self.task_buffers[task].oldest_row() for task in tasks])
+        return (oldest[:, None] + (uniform * sizes[:, None]).astype(np.int64)) % self._max_replay_buffer_size
+
+    def random_rows_multi(self, tasks, batch_size, sequence=False, rng=np.random):
+        '''
+        (task, batch) storage rows of random batches from several tasks
+        :param rng: np.random.RandomState to draw from, defaults to the global one
+        '''
+        return self.rows_from_uniform_multi(tasks, rng.random_sample((len(tasks), batch_size)), sequence=sequence)
+
+    def update_priorities_multi(self, tasks, rows, td_errors):
+        ''' set the priorities of (task, batch) storage rows from their (task, batch) TD errors '''
+        for task, task_rows, task_errors in zip(tasks, rows, td_errors):
+            self.task_buffers[task].update_priorities(task_rows, task_errors)
+
+    def importance_weights_multi(self, tasks, rows, beta):
+        ''' (task, batch) importance sampling weights of prioritized rows, see SimpleReplayBuffer '''
+        return np.stack([
+            self.task_buffers[task].importance_weights(task_rows, beta) for task, task_rows in zip(tasks, rows)
+        ])
+
+    def sample_data_multi(self, tasks, rows):
+        '''
+        gather (task, batch) storage rows into (task, batch, feat) arrays
+        with contiguous storage this is one gather per column
+        '''
+        if self._storage is None:
+            return stack_batches([self.task_buffers[task].sample_data(task_rows) for task, task_rows in zip(tasks, rows)])
+        buffer_rows = np.array([self._task_rows[task] for task in tasks])
+        batch = dict(
+            (key, self._storage[attr][buffer_rows[:, None], rows].astype(SAMPLE_DTYPE, copy=False))
+            for key, attr in self._batch_keys.items()
+        )
+        if 'next_observations' not in batch:
+            batch['next_observations'] = self.next_observations_multi(tasks, rows).astype(SAMPLE_DTYPE, copy=False)
+        return batch
+
+    def next_observations_multi(self, tasks, rows):
+        ''' next observations of (task, batch) storage rows, for buffers that do not store them '''
+        return np.stack([
+            self.task_buffers[task].next_observations(task_rows) for task, task_rows in zip(tasks, rows)
+        ])
+
+    def random_batch_multi(self, tasks, batch_size, sequence=False, rng=np.random):
+        ''' batches from several tasks stacked into (task, batch, feat) arrays '''
+        return self.sample_data_multi(tasks, self.random_rows_multi(tasks, batch_size, sequence=sequence, rng=rng))
+
     def num_steps_can_sample(self, task):
         return self.task_buffers[task].num_steps_can_sample()
 
     def add_path(self, task, path):
-        self.task_buffers[task].add_path(path)
+        return self.add_paths(task, [path])[0]
 
     def add_paths(self, task, paths):
-        for path in paths:
-            self.task_buffers[task].add_path(path)
+        '''
+        add paths to a task buffer
+        returns the (absolute start, length) row range of each path, see MultiTaskReplayBufferView
+        '''
+        if self.shared_storage is not None:
+            # rows are reserved through the shared cursor like any sampler process's
+            ranges = self.shared_storage.write_paths(task, paths)
+            self._apply_shared_records()
+            while self.task_buffers[task].num_added() < ranges[-1][0] + ranges[-1][1]:
+                self._apply_shared_records(block=True)
+            # rows of other writers applied on the way are left for the next ingest_shared
+            ingested = self._ingested[task]
+            ingested[:] = [r for r in ingested if r not in ranges]
+            return ranges
+        ranges = self.task_buffers[task].add_paths(paths)
+        self._record_write(task, sum(length for _, length in ranges))
+        return ranges
+
+    def ingest_shared(self, block=False, timeout=None):
+        '''
+        add the rows sampler processes have written to shared storage, see SharedStorage
+        records are applied in cursor order, ones that arrive ahead of an unfinished write wait for it
+        :param block: wait for at least one record
+        :return: dict of task -> (absolute start, length) of the episodes added, e.g. for
+            MultiTaskReplayBufferView.add_ranges
+        '''
+        self._apply_shared_records(block=block, timeout=timeout)
+        ranges = dict([(task, task_ranges) for task, task_ranges in self._ingested.items() if task_ranges])
+        self._ingested = dict([(idx, []) for idx in self.task_buffers])
+        return ranges
+
+    def _apply_shared_records(self, block=False, timeout=None):
+        for record in self.shared_storage.get_records(block=block, timeout=timeout):
+            self._pending[record[0]][record[1]] = record
+        for task, pending in self._pending.items():
+            buf = self.task_buffers[task]
+            while buf.num_added() in pending:
+                _, _, num_rows, starts, lengths, final_obs = pending.pop(buf.num_added())
+                self._ingested[task] += buf.commit_rows(num_rows, starts, lengths, final_obs)
+                self._record_write(task, num_rows)
+
+    def add_columns(self, task, columns, episode_starts, episode_lengths, final_obs=None):
+        ''' add storage columns to a task buffer, see SimpleReplayBuffer.add_columns '''
+        ranges = self.task_buffers[task].add_columns(columns, episode_starts, episode_lengths, final_obs)
+        self._record_write(task, len(next(iter(columns.values()))))
+        return ranges
 
     def clear_buffer(self, task):
         self.task_buffers[task].clear()
+        if self.shared_storage is not None:
+            self.shared_storage.reset_cursor(task)
+            self._pending[task].clear()
+            self._ingested[task] = []
+        self._chunks[task].clear()
+        self._chunk_rows[task] = 0
+
+
+class MultiTaskReplayBufferView(object):
+    '''
+    subset of the transitions of a MultiTaskReplayBuffer
+
+    stores row ranges rather than transitions, so data that goes into
+    both the buffer and the view is only held in memory once
+    '''
+    def __init__(self, replay_buffer):
+        self.replay_buffer = replay_buffer
+        self.task_buffers = dict([(idx, SimpleReplayBufferView(buf))
+                                  for idx, buf in replay_buffer.task_buffers.items()])
+        replay_buffer.add_view(self)
+
+    def add_ranges(self, task, ranges):
+        ''' add row ranges as returned by MultiTaskReplayBuffer.add_paths '''
+        for start, length in ranges:
+            self.task_buffers[task].add_range(start, length)
+
+    def random_batch(self, task, batch_size, sequence=False):
+        if sequence:
+            batch = self.task_buffers[task].random_sequence(batch_size)
+        else:
+            batch = self.task_buffers[task].random_batch(batch_size)
+        return batch
+
+    def rows_from_uniform_multi(self, tasks, uniform, sequence=False):
+        ''' (task, batch) storage rows of the underlying buffer selected by draws in [0, 1) '''
+        return np.stack([self.task_buffers[task].rows_from_uniform(task_uniform, sequence=sequence)
+                         for task, task_uniform in zip(tasks, uniform)])
+
+    def random_rows_multi(self, tasks, batch_size, sequence=False, rng=np.random):
+        ''' (task, batch) storage rows of the underlying buffer '''
+        return self.rows_from_uniform_multi(tasks, rng.random_sample((len(tasks), batch_size)), sequence=sequence)
+
+    def random_batch_multi(self, tasks, batch_size, sequence=False, rng=np.random):
+        ''' batches from several tasks stacked into (task, batch, feat) arrays '''
+        rows = self.random_rows_multi(tasks, batch_size, sequence=sequence, rng=rng)
+        return self.replay_buffer.sample_data_multi(tasks, rows)
+
+    def num_steps_can_sample(self, task):
+        return self.task_buffers[task].num_steps_can_sample()
+
+    def clear_buffer(self, task):
+        self.task_buffers[task].clear()
+
+    def get_state(self):
+        return dict([(idx, buf.get_state()) for idx, buf in self.task_buffers.items()])
+
+    def set_state(self, states):
+        for idx, state in states.items():
+            self.task_buffers[idx].set_state(state)
+
+
+def stack_batches(batches):
+    ''' stack per-task batches into (task, batch, feat) arrays '''
+    return dict([(key, np.stack([batch[key] for batch in batches])) for key in batches[0]])
 
 
 def get_dim(space):
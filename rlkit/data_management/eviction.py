@@ -0,0 +1,68 @@
+"""
+Policies choosing which task buffers give up rows when a MultiTaskReplayBuffer
+goes over its global transition budget.
+
+A policy gets the live chunks of every task, i.e. deques of [global start, length]
+of the writes still in the buffer, oldest first, where the global start counts rows
+added to any task, and optionally the most rows each task may give up, e.g. because
+the encoder buffer references the rows after them. It returns how many of its oldest
+rows each task evicts.
+"""
+import heapq
+
+
+class OldestFirstEviction(object):
+    ''' evict the rows that were added first, whichever task they belong to '''
+
+    def _evictable(self, chunks):
+        ''' most rows each task may give up '''
+        return dict([(task, sum(length for _, length in task_chunks)) for task, task_chunks in chunks.items()])
+
+    def select(self, chunks, num_rows, limits=None):
+        '''
+        dict of task -> number of its oldest rows to evict, num_rows in total if possible
+        :param limits: dict of task -> most of its oldest rows it may evict, None for no limit
+        '''
+        evictable = self._evictable(chunks)
+        if limits is not None:
+            evictable = dict([(task, min(count, limits[task])) for task, count in evictable.items()])
+        counts = dict([(task, 0) for task in chunks])
+        # position in each task's chunks: chunk index and rows already taken from it
+        positions = dict([(task, (0, 0)) for task in chunks])
+        heap = [(task_chunks[0][0], task) for task, task_chunks in chunks.items()
+                if len(task_chunks) and evictable[task] > 0]
+        heapq.heapify(heap)
+        while num_rows > 0 and heap:
+            _, task = heapq.heappop(heap)
+            index, taken = positions[task]
+            start, length = chunks[task][index]
+            count = min(length - taken, num_rows, evictable[task] - counts[task])
+            counts[task] += count
+            num_rows -= count
+            taken += count
+            if taken == length:
+                index, taken = index + 1, 0
+            positions[task] = (index, taken)
+            if counts[task] < evictable[task] and index < len(chunks[task]):
+                heapq.heappush(heap, (chunks[task][index][0] + taken, task))
+        return counts
+
+
+class MinQuotaEviction(OldestFirstEviction):
+    ''' evict the oldest rows globally, but never shrink a task below min_rows '''
+
+    def __init__(self, min_rows):
+        self.min_rows = min_rows
+
+    def _evictable(self, chunks):
+        sizes = super()._evictable(chunks)
+        return dict([(task, max(size - self.min_rows, 0)) for task, size in sizes.items()])
+
+
+def make_eviction_policy(name, min_task_quota=0):
+    ''' eviction policy by name: 'oldest' or 'quota', which keeps min_task_quota rows per task '''
+    if name == 'oldest':
+        return OldestFirstEviction()
+    elif name == 'quota':
+        return MinQuotaEviction(min_task_quota)
+    raise ValueError("Unknown eviction policy: {}".format(name))
@@ -0,0 +1,79 @@
+"""
+Replay buffer columns backed by np.memmap files, so capacity is bounded by
+disk rather than RAM and a restarted run can reopen the data in place.
+"""
+import os
+import os.path as osp
+import pickle
+
+import numpy as np
+
+
+STATE_FILE = 'buffer_state.pkl'
+
+
+def _open_memmap(file_name, shape, dtype):
+    ''' reopen file_name if it holds an array of this shape and dtype, otherwise create it '''
+    dtype = np.dtype(dtype)
+    num_bytes = int(np.prod(shape)) * dtype.itemsize
+    if osp.exists(file_name):
+        if osp.getsize(file_name) != num_bytes:
+            raise ValueError("{} does not match replay buffer shape {} and dtype {}".format(
+                file_name, shape, dtype))
+        return np.memmap(file_name, dtype=dtype, mode='r+', shape=shape)
+    # the file is sparse on disk until rows are written
+    return np.memmap(file_name, dtype=dtype, mode='w+', shape=shape)
+
+
+def open_memmap_storage(directory, tasks, max_replay_buffer_size, layout, contiguous=False):
+    '''
+    create or reopen memory-mapped replay buffer columns
+
+    contiguous: one file per column holding (num_tasks, max_replay_buffer_size, feat),
+        matching the in-memory contiguous layout so a meta-batch is one gather
+    otherwise: one file per task and column, so each task's rows stay together on
+        disk and sampling a task only pulls that task's pages into the page cache
+
+    :param layout: storage_layout of the task buffers
+    :return: (stacked arrays per attribute or None, per task dict of attribute arrays)
+    '''
+    os.makedirs(directory, exist_ok=True)
+    if contiguous:
+        stacked = dict([
+            (attr, _open_memmap(
+                osp.join(directory, '{}.dat'.format(attr.lstrip('_'))),
+                (len(tasks), max_replay_buffer_size) + shape, dtype))
+            for attr, (shape, dtype) in layout.items()
+        ])
+        task_storage = dict([
+            (task, dict([(attr, array[row]) for attr, array in stacked.items()]))
+            for row, task in enumerate(tasks)
+        ])
+        return stacked, task_storage
+    task_storage = dict([
+        (task, dict([
+            (attr, _open_memmap(
+                osp.join(directory, 'task{}_{}.dat'.format(task, attr.lstrip('_'))),
+                (max_replay_buffer_size,) + shape, dtype))
+            for attr, (shape, dtype) in layout.items()
+        ]))
+        for task in tasks
+    ])
+    return None, task_storage
+
+
+def save_buffer_state(directory, states):
+    ''' write the per-task bookkeeping (see SimpleReplayBuffer.get_state) next to the columns '''
+    file_name = osp.join(directory, STATE_FILE)
+    with open(file_name + '.tmp', 'wb') as f:
+        pickle.dump(states, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def load_buffer_state(directory):
+    ''' per-task bookkeeping saved by save_buffer_state, or None for a new buffer '''
+    file_name = osp.join(directory, STATE_FILE)
+    if not osp.exists(file_name):
+        return None
+    with open(file_name, 'rb') as f:
+        return pickle.load(f)
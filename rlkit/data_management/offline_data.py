@@ -0,0 +1,64 @@
+"""
+Warm-start task buffers from trajectories saved by earlier runs instead of
+collecting the initial pool with the prior policy.
+"""
+import os
+import os.path as osp
+import pickle
+import re
+
+from rlkit.data_management.buffer_snapshot import MANIFEST_FILE, load_buffer_snapshot
+
+
+PATH_FILE = re.compile(r'^task(\d+)\D.*\.pkl$')
+
+
+def iter_path_files(directory):
+    '''
+    yield (task, paths) for every pickled list of paths in directory, one file at a time
+    files are named task<idx>... .pkl, as written by logger.save_extra_data when dumping eval paths
+    '''
+    for file_name in sorted(os.listdir(directory)):
+        match = PATH_FILE.match(file_name)
+        if match is None:
+            continue
+        with open(osp.join(directory, file_name), 'rb') as f:
+            yield int(match.group(1)), pickle.load(f)
+
+
+def dense_reward_paths(paths, sparse_rewards=False):
+    '''
+    paths with the dense rewards the replay buffer stores in 'rewards'
+    eval paths dumped with sparse_rewards hold the sparse rewards there and the dense ones in
+    'dense_rewards', dumps from before that was kept cannot be told apart and are rejected
+    '''
+    for path in paths:
+        if 'dense_rewards' in path:
+            path = dict(path, rewards=path['dense_rewards'])
+        elif sparse_rewards:
+            raise ValueError("Saved paths hold sparse rewards without the dense ones, they cannot be loaded")
+        yield path
+
+
+def load_offline_data(directory, replay_buffer, enc_replay_buffer=None, sparse_rewards=False):
+    '''
+    add saved trajectories to the tasks of replay_buffer, and their rows to enc_replay_buffer
+    :param directory: a buffer snapshot (see BufferSnapshotWriter), loaded in bulk chunk by chunk,
+        or a directory of pickled path lists, added one file at a time
+    :param sparse_rewards: reject path dumps without the dense rewards, which runs with sparse
+        rewards keep, see dense_reward_paths
+    :return: dict of task -> number of transitions loaded, tasks the buffer does not hold are skipped
+    '''
+    tasks = set(replay_buffer.task_buffers.keys())
+    if osp.exists(osp.join(directory, MANIFEST_FILE)):
+        ranges = load_buffer_snapshot(directory, replay_buffer, tasks=tasks)
+    else:
+        ranges = dict()
+        for task, paths in iter_path_files(directory):
+            if task in tasks:
+                paths = list(dense_reward_paths(paths, sparse_rewards))
+                ranges.setdefault(task, []).extend(replay_buffer.add_paths(task, paths))
+    if enc_replay_buffer is not None:
+        for task, task_ranges in ranges.items():
+            enc_replay_buffer.add_ranges(task, task_ranges)
+    return dict([(task, sum(length for _, length in task_ranges)) for task, task_ranges in ranges.items()])
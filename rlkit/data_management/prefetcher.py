@@ -0,0 +1,89 @@
+"""
+Prepare training batches in a background thread while the learner takes gradient steps.
+"""
+from collections import OrderedDict
+import queue
+import threading
+import time
+
+
+class BatchPrefetcher(object):
+    """
+    Calls sample_fn() num_items times in a worker thread and hands the results
+    out in order through a bounded queue.
+
+    sample_fn runs in a single thread in order, so with its own seeded generator
+    (e.g. a SamplingPlan) it yields the same items as sampling synchronously. The
+    buffers must not be written while the prefetcher runs, including their priorities
+    (see MetaRLAlgorithm.update_priorities).
+    """
+
+    def __init__(self, sample_fn, num_items, max_prefetch=2):
+        """
+        :param sample_fn: function returning one item
+        :param num_items: number of items to prepare, the thread exits after the last
+        :param max_prefetch: size of the queue, i.e. how many items are prepared ahead
+        """
+        self._sample_fn = sample_fn
+        self._num_items = num_items
+        self._queue = queue.Queue(maxsize=max_prefetch)
+        self._stop = threading.Event()
+        self._num_hits = 0
+        self._num_gets = 0
+        self._wait_time = 0.
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        ''' put that gives up when the prefetcher is closed, returns whether the item was queued '''
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for _ in range(self._num_items):
+                if not self._put((self._sample_fn(), None)):
+                    return
+        except Exception as e:
+            # hand the error to the learner thread, which raises it from get
+            self._put((None, e))
+
+    def get(self):
+        ''' next item, waiting for the worker if it is not ready yet '''
+        if self._num_gets >= self._num_items:
+            raise IndexError("All {} prefetched items were consumed".format(self._num_items))
+        self._num_gets += 1
+        try:
+            item, error = self._queue.get_nowait()
+            self._num_hits += 1
+        except queue.Empty:
+            start = time.time()
+            item, error = self._queue.get()
+            self._wait_time += time.time() - start
+        if error is not None:
+            self.close()
+            raise error
+        return item
+
+    def close(self):
+        ''' stop the worker, items that were not consumed are dropped '''
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(timeout=0.01)
+
+    def get_diagnostics(self):
+        ''' fraction of gets served without waiting and total time the learner waited '''
+        return OrderedDict([
+            ('Prefetch Hit Rate', self._num_hits / max(self._num_gets, 1)),
+            ('Prefetch Wait Time (s)', self._wait_time),
+        ])
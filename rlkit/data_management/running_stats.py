@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class RunningStats(object):
+    """
+    Count, mean, variance, min and max of a stream of (n, size) batches.
+
+    Batches are folded in with the pairwise merge of Chan et al., which is also
+    how stats of different tasks or workers are combined, so updates cost
+    O(n * size) and reading the stats is O(size). mean and std can be handed to
+    FixedNormalizer.copy_stats.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.mean = np.zeros(self.size, dtype=np.float64)
+        # sum of squared differences from the mean
+        self._m2 = np.zeros(self.size, dtype=np.float64)
+        self.min = np.full(self.size, np.inf)
+        self.max = np.full(self.size, -np.inf)
+
+    @property
+    def var(self):
+        return self._m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def update(self, values):
+        ''' add the rows of a (n, size) batch '''
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.size)
+        if len(values) == 0:
+            return
+        mean = values.mean(axis=0)
+        self._merge(len(values), mean, np.square(values - mean).sum(axis=0), values.min(axis=0), values.max(axis=0))
+
+    def merge(self, other):
+        ''' add the rows summarized by other '''
+        if other.count > 0:
+            self._merge(other.count, other.mean, other._m2, other.min, other.max)
+        return self
+
+    def _merge(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self._m2 = self._m2 + m2 + np.square(delta) * self.count * count / total
+        self.min = np.minimum(self.min, minimum)
+        self.max = np.maximum(self.max, maximum)
+        self.count = total
+
+    def copy(self):
+        return RunningStats(self.size).merge(self)
+
+    @staticmethod
+    def combine(stats):
+        ''' one RunningStats over the rows of all of stats '''
+        stats = list(stats)
+        combined = RunningStats(stats[0].size)
+        for s in stats:
+            combined.merge(s)
+        return combined
+
+    def get_state(self):
+        return dict(count=self.count, mean=self.mean.copy(), m2=self._m2.copy(),
+                    min=self.min.copy(), max=self.max.copy())
+
+    def set_state(self, state):
+        self.count = state['count']
+        self.mean, self._m2 = state['mean'].copy(), state['m2'].copy()
+        self.min, self.max = state['min'].copy(), state['max'].copy()
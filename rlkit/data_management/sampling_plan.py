@@ -0,0 +1,61 @@
+"""
+Random draws of all training steps in an iteration, made up front.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SamplingPlan(object):
+    """
+    Task indices and transition draws of every training step in an iteration.
+
+    The draws of chunk_size steps at a time come from a few vectorized calls on one
+    np.random.RandomState, so the batch sequence only depends on the seed and can be
+    replayed by building the plan again with the same seed. Transitions are drawn as
+    numbers in [0, 1) that the replay buffers map to rows (see rows_from_uniform),
+    which keeps the plan independent of how full each buffer is.
+    """
+
+    def __init__(self, tasks, num_steps, meta_batch, draw_shapes, seed=None, chunk_size=100):
+        """
+        :param tasks: tasks to draw the meta-batch indices from
+        :param num_steps: number of training steps in the plan
+        :param meta_batch: number of task indices per step
+        :param draw_shapes: dict of name -> shape of the draws each step needs
+        :param seed: seed of the plan's RandomState
+        :param chunk_size: number of steps drawn at once, bounds the memory of the plan
+        """
+        self.seed = seed
+        self._tasks = np.asarray(tasks)
+        self._num_steps = num_steps
+        self._meta_batch = meta_batch
+        self._draw_shapes = OrderedDict(draw_shapes)
+        self._chunk_size = chunk_size
+        self._rng = np.random.RandomState(seed)
+        self._step = 0
+        self._chunk_start = 0
+        self._indices = self._tasks[:0]
+        self._draws = OrderedDict()
+
+    def __len__(self):
+        return self._num_steps
+
+    def _draw_chunk(self):
+        num_steps = min(self._chunk_size, self._num_steps - self._step)
+        self._chunk_start = self._step
+        self._indices = self._tasks[self._rng.randint(0, len(self._tasks), (num_steps, self._meta_batch))]
+        self._draws = OrderedDict([
+            (name, self._rng.random_sample((num_steps,) + tuple(shape)))
+            for name, shape in self._draw_shapes.items()
+        ])
+
+    def next_step(self):
+        ''' (task indices, dict of name -> draws) of the next training step '''
+        if self._step >= self._num_steps:
+            raise IndexError("All {} steps of the sampling plan were consumed".format(self._num_steps))
+        if self._step - self._chunk_start >= len(self._indices):
+            self._draw_chunk()
+        offset = self._step - self._chunk_start
+        self._step += 1
+        return self._indices[offset], OrderedDict([(name, draws[offset]) for name, draws in self._draws.items()])
@@ -0,0 +1,184 @@
+"""
+Replay buffer columns in shared memory, so sampler processes can write paths in
+place and the learner only receives records of which rows they wrote.
+"""
+from collections import OrderedDict
+import multiprocessing
+import os
+import os.path as osp
+import queue
+import tempfile
+import uuid
+import weakref
+
+import numpy as np
+
+from rlkit.data_management.simple_replay_buffer import ENV_INFO_PREFIX, path_columns
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8, segments are files on a tmpfs mapped with np.memmap instead
+    shared_memory = None
+
+
+def _segment_dir():
+    return '/dev/shm' if osp.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _open_segment(name, shape, dtype, create):
+    ''' (segment or None, array) of a named shared block, created or attached to '''
+    dtype = np.dtype(dtype)
+    num_bytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    if shared_memory is None:
+        mode = 'w+' if create else 'r+'
+        return None, np.memmap(osp.join(_segment_dir(), name), dtype=dtype, mode=mode, shape=shape)
+    if create:
+        segment = shared_memory.SharedMemory(name=name, create=True, size=num_bytes)
+    else:
+        try:
+            # attaching processes must not unlink the segment when they exit
+            segment = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            segment = shared_memory.SharedMemory(name=name)
+    # new segments read as zeros, and pages are only committed once rows are written to them
+    return segment, np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def _unlink_segments(pid, names, segments):
+    ''' remove the names of the segments, mappings stay valid until every process unmaps them '''
+    if os.getpid() != pid:
+        # a forked child holding a copy of the owner
+        return
+    for name, segment in zip(names, segments):
+        try:
+            if segment is None:
+                os.remove(osp.join(_segment_dir(), name))
+            else:
+                segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedStorage(object):
+    """
+    (num_tasks, max_replay_buffer_size, feat) storage columns in shared memory with
+    a write cursor per task, counting the rows ever reserved for it.
+
+    Created by a MultiTaskReplayBuffer with backend='shared'. Sampler processes get
+    it as a multiprocessing.Process argument and call write_paths, which reserves
+    rows by advancing the cursor under a lock, writes the columns in place and puts
+    a (task, start, num_rows, episodes) record on a queue. The learner applies the
+    records in cursor order with MultiTaskReplayBuffer.ingest_shared.
+
+    Rows are reserved around the ring, so a writer more than max_replay_buffer_size
+    rows ahead of the learner overwrites rows the learner may still sample. Collect
+    and ingest between training phases, as the training loop does, to avoid that.
+    """
+
+    def __init__(self, tasks, max_replay_buffer_size, layout):
+        self.tasks = list(tasks)
+        self.max_replay_buffer_size = max_replay_buffer_size
+        self.layout = layout
+        self._task_rows = dict([(task, row) for row, task in enumerate(self.tasks)])
+        self._prefix = 'rlkit_{}_{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        self._lock = multiprocessing.Lock()
+        self._records = multiprocessing.Queue()
+        self._attach(create=True)
+        self._finalizer = weakref.finalize(
+            self, _unlink_segments, os.getpid(), list(self._segments.keys()), list(self._segments.values()))
+
+    def _attach(self, create):
+        self._segments = OrderedDict()
+        self.arrays = dict()
+        for attr, (shape, dtype) in self.layout.items():
+            name = '{}{}'.format(self._prefix, attr)
+            self._segments[name], self.arrays[attr] = _open_segment(
+                name, (len(self.tasks), self.max_replay_buffer_size) + shape, dtype, create)
+        name = '{}_cursor'.format(self._prefix)
+        self._segments[name], self._cursor = _open_segment(name, (len(self.tasks),), np.int64, create)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ['_segments', 'arrays', '_cursor', '_finalizer']:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach(create=False)
+        self._finalizer = None
+
+    def reader_state(self):
+        '''
+        state of a copy without the lock and record queue, which unlike the storage itself
+        can be pickled outside of process creation, e.g. sent to learner processes
+        '''
+        state = self.__getstate__()
+        state.update(_lock=None, _records=None)
+        return state
+
+    @classmethod
+    def attach_reader(cls, state):
+        ''' storage attached to the columns of a reader_state, for processes that only read rows '''
+        storage = cls.__new__(cls)
+        storage.__setstate__(state)
+        return storage
+
+    def task_arrays(self, task):
+        ''' (max_replay_buffer_size, feat) views of the columns of a task '''
+        row = self._task_rows[task]
+        return dict([(attr, array[row]) for attr, array in self.arrays.items()])
+
+    def reserve(self, task, num_rows):
+        ''' atomically reserve the next num_rows absolute rows of a task, returns the first '''
+        with self._lock:
+            start = int(self._cursor[self._task_rows[task]])
+            self._cursor[self._task_rows[task]] = start + num_rows
+        return start
+
+    def reset_cursor(self, task):
+        ''' start a cleared task over at absolute row 0, no writer may be writing to it '''
+        with self._lock:
+            self._cursor[self._task_rows[task]] = 0
+
+    def write_paths(self, task, paths):
+        '''
+        write complete paths to the rows following the task's cursor and announce them
+        to the learner, returns the (absolute start, length) of the rows each path occupies
+        '''
+        if len(paths) == 0:
+            return []
+        env_info_keys = OrderedDict([
+            (attr[len(ENV_INFO_PREFIX):], shape[0])
+            for attr, (shape, _) in self.layout.items() if attr.startswith(ENV_INFO_PREFIX)
+        ])
+        columns, lengths, final_obs = path_columns(paths, env_info_keys, '_next_obs' in self.layout)
+        num_rows = int(lengths.sum())
+        start = self.reserve(task, num_rows)
+        # rows that would be overwritten within this write are skipped
+        skip = max(0, num_rows - self.max_replay_buffer_size)
+        rows = np.arange(start + skip, start + num_rows) % self.max_replay_buffer_size
+        row = self._task_rows[task]
+        for attr, values in columns.items():
+            self.arrays[attr][row, rows] = values[skip:]
+        starts = np.cumsum(lengths) - lengths
+        self._records.put((task, start, num_rows, starts, lengths, final_obs))
+        return [(int(start + s), int(length)) for s, length in zip(starts, lengths)]
+
+    def get_records(self, block=False, timeout=None):
+        ''' write records announced so far, waiting for at least one if block '''
+        records = []
+        try:
+            if block:
+                records.append(self._records.get(timeout=timeout))
+            while True:
+                records.append(self._records.get_nowait())
+        except queue.Empty:
+            pass
+        return records
+
+    def close(self):
+        ''' remove the segments, only the creating process does so '''
+        if self._finalizer is not None:
+            self._finalizer()
@@ -1,44 +1,351 @@
+from collections import OrderedDict
+
 import numpy as np
 
 from rlkit.data_management.replay_buffer import ReplayBuffer
+from rlkit.data_management.running_stats import RunningStats
+from rlkit.data_management.sum_tree import SumTree
+
+
+# storage dtype of each column, next observations share the observation dtype
+# float16 observations halve the largest arrays in the buffer, at the cost of precision
+DEFAULT_DTYPES = dict(
+    observations=np.float32,
+    actions=np.float32,
+    rewards=np.float32,
+    terminals=np.bool_,
+)
+
+# storage dtype of env_info columns, unless overridden by their key in dtypes
+ENV_INFO_DTYPE = np.float32
+
+# storage attribute behind each key of a sampled batch, env_info columns add key -> ENV_INFO_PREFIX + key
+BATCH_KEYS = OrderedDict([
+    ('observations', '_observations'),
+    ('actions', '_actions'),
+    ('rewards', '_rewards'),
+    ('terminals', '_terminals'),
+    ('next_observations', '_next_obs'),
+])
+
+# prefix of the storage attributes of env_info columns, keeps their keys clear of other attributes
+ENV_INFO_PREFIX = '_info_'
+
+# rows allocated per buffer before any data comes in
+INITIAL_SIZE = 1024
+
+# dtype of the sampled batches, matches what ptu.from_numpy produces
+SAMPLE_DTYPE = np.float32
+
+
+def env_info_schema(env_info_keys):
+    '''
+    env_info columns as an OrderedDict of key -> dim
+    :param env_info_keys: None, keys of scalar values, or a dict of key -> dim
+    '''
+    if env_info_keys is None:
+        return OrderedDict()
+    if isinstance(env_info_keys, dict):
+        return OrderedDict(sorted(env_info_keys.items()))
+    return OrderedDict([(key, 1) for key in env_info_keys])
+
+
+def storage_layout(observation_dim, action_dim, dtypes=None, store_next_observations=True, env_info_keys=None):
+    '''
+    trailing shape and dtype of every storage attribute of SimpleReplayBuffer
+    :param dtypes: optional dict overriding the storage dtype of columns in DEFAULT_DTYPES or env_info columns
+    :param store_next_observations: if False there is no _next_obs column, see SimpleReplayBuffer
+    :param env_info_keys: env_info values stored as float columns, see env_info_schema
+    '''
+    schema = env_info_schema(env_info_keys)
+    column_dtypes = dict(DEFAULT_DTYPES)
+    column_dtypes.update([(key, ENV_INFO_DTYPE) for key in schema])
+    if dtypes is not None:
+        unknown = set(dtypes) - set(column_dtypes)
+        if unknown:
+            raise ValueError("Unknown replay buffer columns: {}".format(sorted(unknown)))
+        column_dtypes.update(dtypes)
+    layout = OrderedDict([
+        ('_observations', ((observation_dim,), column_dtypes['observations'])),
+        # It's a bit memory inefficient to save the observations twice,
+        # but it makes the code *much* easier since you no longer have to
+        # worry about termination conditions.
+        ('_next_obs', ((observation_dim,), column_dtypes['observations'])),
+        ('_actions', ((action_dim,), column_dtypes['actions'])),
+        # Make everything a 2D np array to make it easier for other code to
+        # reason about the shape of the data
+        ('_rewards', ((1,), column_dtypes['rewards'])),
+        # self._terminals[i] = a terminal was received at time i
+        ('_terminals', ((1,), column_dtypes['terminals'])),
+    ])
+    for key, dim in schema.items():
+        layout[ENV_INFO_PREFIX + key] = ((dim,), column_dtypes[key])
+    if not store_next_observations:
+        del layout['_next_obs']
+    return layout
+
+
+def batch_keys(layout):
+    ''' batch key -> storage attribute of the columns of a storage_layout that are sampled as-is '''
+    keys = OrderedDict([(key, attr) for key, attr in BATCH_KEYS.items() if attr in layout])
+    keys.update([(attr[len(ENV_INFO_PREFIX):], attr) for attr in layout if attr.startswith(ENV_INFO_PREFIX)])
+    return keys
+
+
+def env_info_column(paths, key, dim):
+    ''' (steps, dim) values of env_info key over every step of paths, 0 where it is missing '''
+    values = []
+    for path in paths:
+        env_infos = path['env_infos']
+        if isinstance(env_infos, dict):
+            # columnar env_infos, one array per key
+            if key in env_infos:
+                values.append(np.reshape(env_infos[key], (-1, dim)))
+            else:
+                values.append(np.zeros((len(path['observations']), dim)))
+        else:
+            values.append(np.reshape([np.broadcast_to(info.get(key, 0), (dim,)) for info in env_infos], (-1, dim)))
+    return np.concatenate(values)
+
+
+def path_columns(paths, env_info_keys, store_next_observations=True):
+    '''
+    storage columns of complete paths as taken by SimpleReplayBuffer.add_columns
+    :param env_info_keys: OrderedDict of env_info key -> dim, see env_info_schema
+    :return: (columns, path lengths, final observation of each path or None if next observations are stored)
+    '''
+    lengths = np.array([len(path['observations']) for path in paths])
+    columns = dict(
+        _observations=np.concatenate([path['observations'] for path in paths]),
+        _actions=np.concatenate([path['actions'] for path in paths]),
+        _rewards=np.concatenate([np.reshape(path['rewards'], (-1, 1)) for path in paths]),
+        _terminals=np.concatenate([np.reshape(path['terminals'], (-1, 1)) for path in paths]),
+    )
+    for key, dim in env_info_keys.items():
+        columns[ENV_INFO_PREFIX + key] = env_info_column(paths, key, dim)
+    if store_next_observations:
+        columns['_next_obs'] = np.concatenate([path['next_observations'] for path in paths])
+        return columns, lengths, None
+    return columns, lengths, [path['next_observations'][-1] for path in paths]
 
 
 class SimpleReplayBuffer(ReplayBuffer):
     def __init__(
             self, max_replay_buffer_size, observation_dim, action_dim,
+            dtypes=None, initial_size=INITIAL_SIZE, storage=None,
+            store_next_observations=True, prioritized=False,
+            priority_alpha=0.6, priority_eps=1e-6, env_info_keys=None,
     ):
+        """
+        :param dtypes: optional dict overriding the storage dtype of columns in DEFAULT_DTYPES
+        :param initial_size: rows allocated up front, storage doubles as needed up to max_replay_buffer_size
+        :param storage: optional dict of preallocated (max_replay_buffer_size, ...) arrays
+            for every attribute in storage_layout, used as-is instead of growing storage
+        :param store_next_observations: if False, keep a single observation stream plus the
+            final observation of each episode and rebuild next observations when sampling
+        :param env_info_keys: env_info values stored as float columns and sampled under their key,
+            as keys of scalars or a dict of key -> dim, nothing is stored for other env_info keys
+        :param prioritized: sample transitions in proportion to (|TD error| + priority_eps) ** priority_alpha,
+            kept in a SumTree over the storage rows, see update_priorities
+        """
         self._observation_dim = observation_dim
         self._action_dim = action_dim
         self._max_replay_buffer_size = max_replay_buffer_size
-        self._observations = np.zeros((max_replay_buffer_size, observation_dim))
-        # It's a bit memory inefficient to save the observations twice,
-        # but it makes the code *much* easier since you no longer have to
-        # worry about termination conditions.
-        self._next_obs = np.zeros((max_replay_buffer_size, observation_dim))
-        self._actions = np.zeros((max_replay_buffer_size, action_dim))
-        # Make everything a 2D np array to make it easier for other code to
-        # reason about the shape of the data
-        self._rewards = np.zeros((max_replay_buffer_size, 1))
-        self._sparse_rewards = np.zeros((max_replay_buffer_size, 1))
-        # self._terminals[i] = a terminal was received at time i
-        self._terminals = np.zeros((max_replay_buffer_size, 1), dtype='uint8')
+        self._store_next_obs = store_next_observations
+        self._env_info_schema = env_info_schema(env_info_keys)
+        self._layout = storage_layout(observation_dim, action_dim, dtypes, store_next_observations, env_info_keys)
+        self._batch_keys = batch_keys(self._layout)
+        self._priorities = SumTree(0) if prioritized else None
+        self._priority_alpha = priority_alpha
+        self._priority_eps = priority_eps
+        self._stats = dict([
+            (key, RunningStats(self._layout[attr][0][0])) for key, attr in self._batch_keys.items()
+        ])
+        if storage is None:
+            self._capacity = 0
+            for attr, (shape, dtype) in self._layout.items():
+                setattr(self, attr, np.zeros((0,) + shape, dtype=dtype))
+            self._reserve(min(initial_size, max_replay_buffer_size))
+        else:
+            for attr, (shape, dtype) in self._layout.items():
+                assert storage[attr].shape == (max_replay_buffer_size,) + shape, attr
+                setattr(self, attr, storage[attr])
+            self._capacity = max_replay_buffer_size
+            if self._priorities is not None:
+                self._priorities.resize(max_replay_buffer_size)
         self.clear()
 
+    def _storage_attrs(self):
+        return list(self._layout.keys())
+
+    def _reserve(self, num_rows):
+        '''
+        make sure rows [0, num_rows) are allocated, growing storage geometrically
+        storage only grows before the ring buffer first wraps, so rows keep their position
+        '''
+        if num_rows <= self._capacity:
+            return
+        capacity = min(max(num_rows, 2 * self._capacity), self._max_replay_buffer_size)
+        for attr in self._storage_attrs():
+            old = getattr(self, attr)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._capacity] = old
+            setattr(self, attr, new)
+        if self._priorities is not None:
+            self._priorities.resize(capacity)
+        self._capacity = capacity
+
+    def _compact(self, num_rows):
+        '''
+        before num_rows are written past the allocated rows, move the live rows to the front
+        instead of growing storage if evict_oldest has freed at least half of it
+        only happens before the ring buffer first wraps, when the live rows are [top - size, top)
+        '''
+        dead = self._top - self._size
+        if (self._capacity == self._max_replay_buffer_size or self._top + num_rows <= self._capacity
+                or dead < self._capacity // 2):
+            return
+        for attr in self._storage_attrs():
+            storage = getattr(self, attr)
+            storage[:self._size] = storage[dead:self._top].copy()
+        if self._priorities is not None:
+            priorities = self._priorities.get(np.arange(dead, self._top))
+            self._priorities.clear()
+            self._priorities.update(np.arange(self._size), priorities)
+        self._top = self._size
+        self._row_offset += dead
+
+    def evict_oldest(self, num_rows):
+        ''' drop the oldest num_rows rows, their storage is reused by later writes '''
+        num_rows = min(num_rows, self._size)
+        if self._priorities is not None:
+            oldest = self.oldest_absolute_row()
+            self._priorities.update(self.absolute_to_rows(np.arange(oldest, oldest + num_rows)), 0)
+        self._size -= num_rows
+
     def add_sample(self, observation, action, reward, terminal,
                    next_observation, **kwargs):
+        self._compact(1)
+        self._reserve(self._top + 1)
         self._observations[self._top] = observation
         self._actions[self._top] = action
         self._rewards[self._top] = reward
         self._terminals[self._top] = terminal
-        self._next_obs[self._top] = next_observation
-        self._sparse_rewards[self._top] = kwargs['env_info'].get('sparse_reward', 0)
+        if self._store_next_obs:
+            self._next_obs[self._top] = next_observation
+        # kept for terminate_episode when next observations are derived
+        self._last_next_obs = next_observation
+        for key in self._env_info_schema:
+            getattr(self, ENV_INFO_PREFIX + key)[self._top] = kwargs['env_info'].get(key, 0)
+        self._reset_priorities([self._top])
+        self._update_stats(slice(self._top, self._top + 1))
         self._advance()
 
+    def add_path(self, path):
+        '''
+        add a path and return the (absolute start, length) of the rows it occupies
+        '''
+        return self.add_paths([path])[0]
+
+    def add_paths(self, paths):
+        '''
+        add complete paths with one slice assignment per column (two if the ring buffer wraps)
+        returns the (absolute start, length) of the rows each path occupies
+        '''
+        if len(paths) == 0:
+            return []
+        columns, lengths, final_obs = path_columns(paths, self._env_info_schema, self._store_next_obs)
+        return self.add_columns(columns, np.cumsum(lengths) - lengths, lengths, final_obs)
+
+    def add_columns(self, columns, episode_starts, episode_lengths, final_obs=None):
+        '''
+        add rows given as storage columns, with episode bookkeeping as if terminate_episode
+        had been called after each episode
+        :param columns: dict of storage attribute -> rows, attributes outside the layout are ignored
+        :param episode_starts: start of each episode relative to the first row, negative for
+            episodes that began in rows added by the previous call
+        :param final_obs: observation each episode ended in, needed if next observations are not stored
+        returns the (absolute start, length) of each episode
+        '''
+        first = self._num_added
+        self._add_rows(dict([(attr, columns[attr]) for attr in self._storage_attrs()]))
+        return self._add_episodes(first, episode_starts, episode_lengths, final_obs)
+
+    def commit_rows(self, num_rows, episode_starts, episode_lengths, final_obs=None):
+        '''
+        add_columns for num_rows rows another process has already written to the storage
+        rows following the newest row, e.g. through SharedStorage
+        storage must be preallocated, so absolute row i lives at storage row i % max size
+        '''
+        first = self._num_added
+        self._commit(num_rows)
+        return self._add_episodes(first, episode_starts, episode_lengths, final_obs)
+
+    def _add_episodes(self, first, episode_starts, episode_lengths, final_obs):
+        starts = first + np.asarray(episode_starts, dtype=np.int64)
+        self._episodes.append(starts, episode_lengths, final_obs)
+        self._cur_episode_start = self._num_added
+        return [(int(start), int(length)) for start, length in zip(starts, episode_lengths)]
+
+    def export_rows(self, start, end):
+        '''
+        storage columns of the live absolute rows [start, end) and the episodes ending in them,
+        as taken by add_columns
+        :return: (columns, episode starts relative to start, episode lengths, final observations or None)
+        '''
+        rows = self.absolute_to_rows(np.arange(start, end))
+        columns = dict([(attr, getattr(self, attr)[rows]) for attr in self._storage_attrs()])
+        starts, lengths, final_obs = self._episodes.overlapping(self.oldest_absolute_row())
+        ends = starts + lengths
+        selected = (ends > start) & (ends <= end)
+        if final_obs is not None:
+            final_obs = final_obs[selected]
+        return columns, starts[selected] - start, lengths[selected], final_obs
+
+    def num_added(self):
+        ''' absolute row number of the next row to be added '''
+        return self._num_added
+
+    def _add_rows(self, columns):
+        '''
+        write equal-length arrays into the storage attributes named by the keys of columns
+        and advance the buffer, only the most recent max_replay_buffer_size rows are kept
+        '''
+        num_rows = len(next(iter(columns.values())))
+        self._compact(num_rows)
+        # rows that would be overwritten within this write are skipped
+        skip = max(0, num_rows - self._max_replay_buffer_size)
+        start = (self._top + skip) % self._max_replay_buffer_size
+        first = min(num_rows - skip, self._max_replay_buffer_size - start)
+        rest = num_rows - skip - first
+        self._reserve(start + first)
+        for attr, values in columns.items():
+            storage = getattr(self, attr)
+            storage[start:start + first] = values[skip:skip + first]
+            if rest > 0:
+                storage[:rest] = values[skip + first:]
+        self._commit(num_rows)
+
+    def _commit(self, num_rows):
+        ''' advance the buffer over num_rows rows just written after the newest row '''
+        written = min(num_rows, self._max_replay_buffer_size)
+        start = (self._top + num_rows - written) % self._max_replay_buffer_size
+        first = min(written, self._max_replay_buffer_size - start)
+        self._reset_priorities(np.arange(start, start + first))
+        self._reset_priorities(np.arange(written - first))
+        self._update_stats(slice(start, start + first))
+        self._update_stats(slice(0, written - first))
+        self._top = (self._top + num_rows) % self._max_replay_buffer_size
+        self._size = min(self._size + num_rows, self._max_replay_buffer_size)
+        self._num_added += num_rows
+
     def terminate_episode(self):
-        # store the episode beginning once the episode is over
-        # n.b. allows last episode to loop but whatever
-        self._episode_starts.append(self._cur_episode_start)
-        self._cur_episode_start = self._top
+        # store the episode once it is over, in absolute rows
+        if self._num_added > self._cur_episode_start:
+            final_obs = None if self._store_next_obs else [self._last_next_obs]
+            self._episodes.append(
+                [self._cur_episode_start], [self._num_added - self._cur_episode_start], final_obs)
+        self._cur_episode_start = self._num_added
 
     def size(self):
         return self._size
@@ -46,43 +353,335 @@ class SimpleReplayBuffer(ReplayBuffer):
     def clear(self):
         self._top = 0
         self._size = 0
-        self._episode_starts = []
+        # rows ever added since the last clear, absolute row i lives at i % max size
+        self._num_added = 0
+        # absolute row i lives at storage row (i - row offset) % max size, the offset
+        # only changes when evicted rows are compacted away
+        self._row_offset = 0
+        self._episodes = self._new_episode_index()
         self._cur_episode_start = 0
+        for stats in self._stats.values():
+            stats.clear()
+        if self._priorities is not None:
+            self._priorities.clear()
+            self._max_priority = 1.
+
+    def _new_episode_index(self):
+        if self._store_next_obs:
+            return EpisodeIndex()
+        return EpisodeIndex(observation_dim=self._observation_dim,
+                            observation_dtype=self._layout['_observations'][1])
+
+    def get_state(self):
+        ''' bookkeeping needed to reattach to the same storage, see set_state '''
+        starts, lengths, final_obs = self._episodes.overlapping(self.oldest_absolute_row())
+        return dict(
+            top=self._top,
+            size=self._size,
+            num_added=self._num_added,
+            row_offset=self._row_offset,
+            cur_episode_start=self._cur_episode_start,
+            episode_starts=starts.copy(),
+            episode_lengths=lengths.copy(),
+            episode_final_obs=None if final_obs is None else final_obs.copy(),
+            stats=dict([(key, stats.get_state()) for key, stats in self._stats.items()]),
+        )
+
+    def set_state(self, state):
+        ''' restore bookkeeping saved by get_state, the storage must already hold the rows '''
+        self._reserve(state['size'])
+        self._top = state['top']
+        self._size = state['size']
+        self._num_added = state['num_added']
+        self._row_offset = state.get('row_offset', 0)
+        self._cur_episode_start = state['cur_episode_start']
+        self._episodes = self._new_episode_index()
+        self._episodes.append(state['episode_starts'], state['episode_lengths'], state.get('episode_final_obs'))
+        if 'stats' in state:
+            for key, stats in self._stats.items():
+                stats.set_state(state['stats'][key])
+        else:
+            # states saved without stats, start over from the live rows
+            rows = self.absolute_to_rows(np.arange(self.oldest_absolute_row(), self._num_added))
+            for stats in self._stats.values():
+                stats.clear()
+            self._update_stats(rows)
+        # priorities are not saved, restored rows start out equally likely
+        if self._priorities is not None:
+            self._priorities.clear()
+            oldest = self.oldest_absolute_row()
+            self._reset_priorities(self.absolute_to_rows(np.arange(oldest, self._num_added)))
+
+    def _update_stats(self, rows):
+        ''' fold newly written storage rows into the running stats '''
+        for key, attr in self._batch_keys.items():
+            self._stats[key].update(getattr(self, attr)[rows])
+
+    def stats(self):
+        '''
+        batch key -> RunningStats of that column over every row written since the last clear,
+        rows that were since overwritten or evicted included
+        '''
+        return self._stats
+
+    def _reset_priorities(self, rows):
+        ''' newly written rows get the highest priority seen so far, so they are sampled at least once '''
+        if self._priorities is not None:
+            self._priorities.update(rows, self._max_priority)
+
+    def update_priorities(self, indices, td_errors):
+        ''' set the priorities of the rows at indices from their TD errors '''
+        priorities = (np.abs(np.reshape(td_errors, -1)) + self._priority_eps) ** self._priority_alpha
+        self._priorities.update(indices, priorities)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def importance_weights(self, indices, beta):
+        '''
+        weights (size * P(row)) ** -beta correcting for prioritized sampling, normalized by
+        their maximum so they only scale losses down
+        '''
+        if self._priorities is None or beta == 0:
+            return np.ones(len(indices), dtype=SAMPLE_DTYPE)
+        probs = self._priorities.get(indices) / self._priorities.total()
+        weights = (self._size * probs) ** -beta
+        return (weights / weights.max()).astype(SAMPLE_DTYPE)
 
     def _advance(self):
         self._top = (self._top + 1) % self._max_replay_buffer_size
         if self._size < self._max_replay_buffer_size:
             self._size += 1
+        self._num_added += 1
+
+    def absolute_to_rows(self, absolute_indices):
+        ''' map absolute row numbers (as returned by add_path) to storage rows '''
+        return (absolute_indices - self._row_offset) % self._max_replay_buffer_size
+
+    def rows_to_absolute(self, rows):
+        ''' map storage rows of live data back to absolute row numbers '''
+        oldest = self.oldest_absolute_row()
+        return oldest + (np.asarray(rows) - self.oldest_row()) % self._max_replay_buffer_size
+
+    def oldest_row(self):
+        ''' storage row of the oldest live row, live rows follow it around the ring '''
+        return self.absolute_to_rows(self.oldest_absolute_row())
+
+    def oldest_absolute_row(self):
+        ''' absolute rows below this one have been overwritten '''
+        return self._num_added - self._size
 
     def sample_data(self, indices):
-        return dict(
-            observations=self._observations[indices],
-            actions=self._actions[indices],
-            rewards=self._rewards[indices],
-            terminals=self._terminals[indices],
-            next_observations=self._next_obs[indices],
-            sparse_rewards=self._sparse_rewards[indices],
+        '''
+        gather rows, casting compact storage to SAMPLE_DTYPE so that
+        torch.from_numpy can take the arrays as-is
+        '''
+        batch = dict(
+            (key, getattr(self, attr)[indices].astype(SAMPLE_DTYPE, copy=False))
+            for key, attr in self._batch_keys.items()
         )
+        if not self._store_next_obs:
+            batch['next_observations'] = self.next_observations(indices).astype(SAMPLE_DTYPE, copy=False)
+        return batch
+
+    def next_observations(self, indices):
+        '''
+        rebuild next observations of the rows at indices from the single observation stream:
+        the next row within an episode, the stored final observation at its end
+        '''
+        indices = np.asarray(indices)
+        absolute = self.rows_to_absolute(indices)
+        starts, lengths, final_obs = self._episodes.overlapping(self.oldest_absolute_row())
+        # rows past the capacity only occur before the buffer wraps, as the last row of an episode
+        next_obs = self._observations[(indices + 1) % self._capacity]
+        if len(starts) > 0:
+            episodes = np.searchsorted(starts, absolute, side='right') - 1
+            is_last = (episodes >= 0) & (absolute == starts[episodes] + lengths[episodes] - 1)
+            next_obs[is_last] = final_obs[episodes[is_last]]
+        return next_obs
+
+    def rows_from_uniform(self, uniform, sequence=False):
+        '''
+        storage rows selected by draws in [0, 1), one per transition, whole trajectories if sequence
+        draws are spread evenly over the rows (weighted by priority if prioritized) or episodes, see SamplingPlan
+        '''
+        if sequence:
+            starts, lengths = self._episodes.live(self.oldest_absolute_row())
+            return self.absolute_to_rows(random_sequence_indices(starts, lengths, uniform))
+        if self._priorities is not None:
+            return self._priorities.find(uniform * self._priorities.total())
+        return (self.oldest_row() + (uniform * self._size).astype(np.int64)) % self._max_replay_buffer_size
+
+    def random_rows(self, batch_size, sequence=False, rng=np.random):
+        '''
+        storage rows of a random batch, whole trajectories if sequence
+        :param rng: np.random.RandomState to draw from, defaults to the global one
+        '''
+        return self.rows_from_uniform(rng.random_sample(batch_size), sequence=sequence)
 
     def random_batch(self, batch_size):
         ''' batch of unordered transitions '''
-        indices = np.random.randint(0, self._size, batch_size)
-        return self.sample_data(indices)
+        return self.sample_data(self.random_rows(batch_size))
 
     def random_sequence(self, batch_size):
         ''' batch of trajectories '''
-        # take random trajectories until we have enough
-        i = 0
-        indices = []
-        while len(indices) < batch_size:
-            # TODO hack to not deal with wrapping episodes, just don't take the last one
-            start = np.random.choice(self.episode_starts[:-1])
-            pos_idx = self._episode_starts.index(start)
-            indices += list(range(start, self._episode_starts[pos_idx + 1]))
-            i += 1
-        # cut off the last traj if needed to respect batch size
-        indices = indices[:batch_size]
-        return self.sample_data(indices)
+        return self.sample_data(self.random_rows(batch_size, sequence=True))
 
     def num_steps_can_sample(self):
         return self._size
+
+
+class SimpleReplayBufferView(object):
+    """
+    Index view over the rows of a SimpleReplayBuffer.
+
+    Holds (absolute start, length) row ranges into the underlying buffer rather than
+    a copy of the transitions. Ranges that the buffer has since overwritten are dropped.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.clear()
+
+    def add_range(self, start, length):
+        if length > 0:
+            self._ranges.append([start], [length])
+
+    def clear(self):
+        self._ranges = EpisodeIndex()
+
+    def get_state(self):
+        ''' ranges the buffer still holds '''
+        starts, lengths, _ = self._live_ranges()
+        return dict(starts=starts.copy(), lengths=lengths.copy())
+
+    def set_state(self, state):
+        self.clear()
+        self._ranges.append(state['starts'], state['lengths'])
+
+    def first_referenced_row(self):
+        ''' absolute row the oldest live range starts at, None if there is none '''
+        starts, _, _ = self._live_ranges()
+        return int(starts[0]) if len(starts) else None
+
+    def _live_ranges(self):
+        ''' starts, lengths and end offsets of the ranges the buffer still holds '''
+        starts, lengths = self._ranges.live(self.buffer.oldest_absolute_row())
+        return starts, lengths, np.cumsum(lengths)
+
+    def size(self):
+        return self.num_steps_can_sample()
+
+    def num_steps_can_sample(self):
+        _, _, ends = self._live_ranges()
+        return int(ends[-1]) if len(ends) else 0
+
+    def rows_from_uniform(self, uniform, sequence=False):
+        ''' storage rows selected by draws in [0, 1), see SimpleReplayBuffer.rows_from_uniform '''
+        starts, lengths, ends = self._live_ranges()
+        if len(ends) == 0:
+            raise ValueError("Cannot sample from a replay buffer view whose rows were all overwritten or evicted")
+        if sequence:
+            absolute = random_sequence_indices(starts, lengths, uniform)
+        else:
+            offsets = (uniform * ends[-1]).astype(np.int64)
+            ranges = np.searchsorted(ends, offsets, side='right')
+            absolute = starts[ranges] + offsets - (ends[ranges] - lengths[ranges])
+        return self.buffer.absolute_to_rows(absolute)
+
+    def random_rows(self, batch_size, sequence=False, rng=np.random):
+        ''' storage rows of a random batch, whole trajectories if sequence '''
+        return self.rows_from_uniform(rng.random_sample(batch_size), sequence=sequence)
+
+    def random_batch(self, batch_size):
+        ''' batch of unordered transitions '''
+        return self.buffer.sample_data(self.random_rows(batch_size))
+
+    def random_sequence(self, batch_size):
+        ''' batch of trajectories '''
+        return self.buffer.sample_data(self.random_rows(batch_size, sequence=True))
+
+
+class EpisodeIndex(object):
+    """
+    (absolute start, length) of episodes in growable numpy arrays, optionally
+    with the observation each episode ended in.
+
+    Episodes are appended in the order they are stored, so the ones a ring buffer
+    has overwritten always form a prefix that can be dropped with a binary search.
+    """
+
+    def __init__(self, initial_size=64, observation_dim=None, observation_dtype=np.float32):
+        self._starts = np.zeros(initial_size, dtype=np.int64)
+        self._lengths = np.zeros(initial_size, dtype=np.int64)
+        self._final_obs = None
+        if observation_dim is not None:
+            self._final_obs = np.zeros((initial_size, observation_dim), dtype=observation_dtype)
+        self._first = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count - self._first
+
+    def _arrays(self):
+        arrays = ['_starts', '_lengths']
+        if self._final_obs is not None:
+            arrays.append('_final_obs')
+        return arrays
+
+    def append(self, starts, lengths, final_obs=None):
+        num = len(starts)
+        if self._count + num > len(self._starts):
+            # reclaim the dropped prefix before growing
+            live = self._count - self._first
+            for attr in self._arrays():
+                array = getattr(self, attr)
+                array[:live] = array[self._first:self._count].copy()
+            self._first, self._count = 0, live
+            if live + num > len(self._starts):
+                size = max(2 * len(self._starts), live + num)
+                for attr in self._arrays():
+                    array = getattr(self, attr)
+                    setattr(self, attr, np.resize(array, (size,) + array.shape[1:]))
+        self._starts[self._count:self._count + num] = starts
+        self._lengths[self._count:self._count + num] = lengths
+        if self._final_obs is not None:
+            self._final_obs[self._count:self._count + num] = final_obs
+        self._count += num
+
+    def overlapping(self, oldest):
+        '''
+        starts, lengths and final observations (None if not tracked) of the episodes
+        that still have rows at or after absolute row oldest, the others are dropped
+        '''
+        ends = self._starts[self._first:self._count] + self._lengths[self._first:self._count]
+        self._first += np.searchsorted(ends, oldest, side='right')
+        final_obs = None
+        if self._final_obs is not None:
+            final_obs = self._final_obs[self._first:self._count]
+        return self._starts[self._first:self._count], self._lengths[self._first:self._count], final_obs
+
+    def live(self, oldest):
+        '''
+        starts and lengths of the episodes that begin at or after absolute row oldest,
+        episodes that begin earlier have been (at least partly) overwritten
+        '''
+        starts, lengths, _ = self.overlapping(oldest)
+        first = np.searchsorted(starts, oldest, side='left')
+        return starts[first:], lengths[first:]
+
+
+def random_sequence_indices(starts, lengths, uniform):
+    '''
+    absolute indices of whole random episodes laid end to end, cut off at batch_size
+    the episodes are selected by the batch_size draws in [0, 1) of uniform,
+    every episode has at least one step, so batch_size draws are always enough
+    '''
+    batch_size = len(uniform)
+    episodes = (uniform * len(starts)).astype(np.int64)
+    ends = np.cumsum(lengths[episodes])
+    num_episodes = np.searchsorted(ends, batch_size, side='left') + 1
+    episodes, ends = episodes[:num_episodes], ends[:num_episodes]
+    episode_lengths = lengths[episodes]
+    # position of each step within its episode
+    offsets = np.arange(ends[-1]) - np.repeat(ends - episode_lengths, episode_lengths)
+    indices = np.repeat(starts[episodes], episode_lengths) + offsets
+    return indices[:batch_size]
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class SumTree(object):
+    """
+    Array-backed binary tree whose internal nodes hold the sum of their children,
+    for sampling leaves in proportion to their priority.
+
+    Node 1 is the root and the children of node i are 2i and 2i + 1, leaves are the
+    last num_leaves nodes. Updates and lookups take batches of leaves and walk the
+    tree one level at a time, so both are O(batch * log n) with a numpy op per level.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = 0
+        self._num_leaves = 1
+        self._tree = np.zeros(2, dtype=np.float64)
+        self.resize(capacity)
+
+    def __len__(self):
+        return self._capacity
+
+    def resize(self, capacity):
+        ''' change the number of leaves, keeping the priorities of the leaves that remain '''
+        num_leaves = 1
+        while num_leaves < capacity:
+            num_leaves *= 2
+        leaves = self._tree[self._num_leaves:self._num_leaves + min(capacity, self._capacity)]
+        self._tree = np.zeros(2 * num_leaves, dtype=np.float64)
+        self._tree[num_leaves:num_leaves + len(leaves)] = leaves
+        self._num_leaves = num_leaves
+        self._capacity = capacity
+        # rebuild the internal nodes level by level
+        level = num_leaves // 2
+        while level >= 1:
+            self._tree[level:2 * level] = self._tree[2 * level:4 * level:2] + self._tree[2 * level + 1:4 * level:2]
+            level //= 2
+
+    def clear(self):
+        self._tree[:] = 0
+
+    def total(self):
+        return self._tree[1]
+
+    def get(self, indices):
+        return self._tree[np.asarray(indices) + self._num_leaves]
+
+    def update(self, indices, priorities):
+        ''' set the priorities of leaves, with repeated indices the last priority wins '''
+        nodes = np.asarray(indices, dtype=np.int64).reshape(-1) + self._num_leaves
+        if len(nodes) == 0:
+            return
+        self._tree[nodes] = priorities
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+
+    def find(self, values):
+        '''
+        leaves at which the running sum of priorities reaches values, for values in [0, total)
+        leaves with zero priority are never returned
+        '''
+        values = np.array(values, dtype=np.float64).reshape(-1)
+        nodes = np.ones(len(values), dtype=np.int64)
+        # all nodes are on the same level, so they reach the leaves together
+        for _ in range(int(np.log2(self._num_leaves))):
+            left = 2 * nodes
+            left_sum = self._tree[left]
+            # rounding can leave a value at the very end of the range, never walk into an empty subtree
+            go_right = (values >= left_sum) & (self._tree[left + 1] > 0)
+            values = values - left_sum * go_right
+            nodes = left + go_right
+        return nodes - self._num_leaves
@@ -85,6 +85,9 @@ class SparsePointEnv(PointEnv):
      NOTE that `step()` returns the dense reward because this is used during meta-training
      the algorithm should call `sparsify_rewards()` to get the sparse rewards
      '''
+    # env_info values stored by the replay buffer, see MultiTaskReplayBuffer
+    env_info_keys = ('sparse_reward',)
+
     def __init__(self, randomize_tasks=False, n_tasks=2, goal_radius=0.2):
         super().__init__(randomize_tasks, n_tasks)
         self.goal_radius = goal_radius
@@ -0,0 +1,41 @@
+"""
+Opt-in compilation of network forwards with torch.compile, on torch versions that have it.
+"""
+import time
+
+import torch
+
+
+def can_compile():
+    return hasattr(torch, 'compile')
+
+
+def compile_forward(module, **kwargs):
+    '''
+    replace forward with a compiled version on this instance only, so state dict keys,
+    pickling and copies of the module are unaffected
+    :return: whether the module was compiled, False if torch has no torch.compile
+    '''
+    if not can_compile():
+        return False
+    # buffers donated to a compiled backward rule out backward(retain_graph=True), which the
+    # KL and Q losses take through the context encoder
+    functorch_config = getattr(getattr(torch, '_functorch', None), 'config', None)
+    if hasattr(functorch_config, 'donated_buffer'):
+        functorch_config.donated_buffer = False
+    module.forward = torch.compile(module.forward, **kwargs)
+    return True
+
+
+def uncompile_forward(module):
+    ''' go back to the eager forward of the class '''
+    module.__dict__.pop('forward', None)
+
+
+def time_calls(fn, num_calls=10):
+    ''' average seconds per call of fn, after one untimed call '''
+    fn()
+    start = time.time()
+    for _ in range(num_calls):
+        fn()
+    return (time.time() - start) / num_calls
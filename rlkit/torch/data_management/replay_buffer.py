@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.data_management.env_replay_buffer import MultiTaskReplayBuffer, MultiTaskReplayBufferView
+
+
+def torch_dtype(np_dtype):
+    ''' torch dtype matching a numpy dtype '''
+    return torch.from_numpy(np.zeros(1, dtype=np_dtype)).dtype
+
+
+class TorchMultiTaskReplayBuffer(MultiTaskReplayBuffer):
+    """
+    Contiguous multi-task replay buffer whose columns are torch tensors.
+
+    Rows are written through numpy views of the (pinned, when training on the GPU)
+    host tensors, and batches are gathered with torch.index_select into output
+    tensors that are allocated once and reused, so sampling skips the numpy -> torch
+    conversion and allocates nothing per step.
+
+    Reused outputs are overwritten by the next call with the same name, so a batch
+    must be consumed before sampling the next one under that name.
+    """
+
+    def __init__(
+            self,
+            max_replay_buffer_size,
+            env,
+            tasks,
+            pin_memory=None,
+            **kwargs
+    ):
+        """
+        :param pin_memory: page-lock the storage for fast copies to the GPU,
+            defaults to whether GPU mode is on
+
+        other keyword arguments are passed on to MultiTaskReplayBuffer,
+        storage is always contiguous and in memory
+        """
+        if pin_memory is None:
+            pin_memory = ptu.gpu_enabled()
+        self._pin_memory = pin_memory
+        self._tensors = None
+        self._outputs = dict()
+        super().__init__(
+            max_replay_buffer_size,
+            env,
+            tasks,
+            contiguous=True,
+            **kwargs
+        )
+
+    def _allocate_contiguous(self, layout, num_tasks, max_replay_buffer_size):
+        self._tensors = dict()
+        for attr, (shape, dtype) in layout.items():
+            tensor = torch.zeros((num_tasks, max_replay_buffer_size) + shape, dtype=torch_dtype(dtype))
+            if self._pin_memory:
+                tensor = tensor.pin_memory()
+            self._tensors[attr] = tensor
+        # task buffers write rows through numpy views that share memory with the tensors
+        return dict([(attr, tensor.numpy()) for attr, tensor in self._tensors.items()])
+
+    def _output(self, name, key, shape, dtype=torch.float32, device=None, pin_memory=False):
+        ''' preallocated tensor reused across calls with the same name and shape '''
+        cache_key = (name, key, shape, dtype)
+        if cache_key not in self._outputs:
+            tensor = torch.empty(shape, dtype=dtype, device=device)
+            if pin_memory:
+                tensor = tensor.pin_memory()
+            self._outputs[cache_key] = tensor
+        return self._outputs[cache_key]
+
+    def sample_data_multi_torch(self, tasks, rows, name='default'):
+        '''
+        gather (task, batch) storage rows into (task, batch, feat) float tensors on ptu.device
+        :param name: outputs are reused between calls with the same name
+        '''
+        num_tasks, batch_size = rows.shape
+        max_size = self._tensors['_observations'].size(1)
+        buffer_rows = np.array([self._task_rows[task] for task in tasks])
+        flat_rows = torch.from_numpy((buffer_rows[:, None] * max_size + rows).reshape(-1))
+        device = ptu.device if ptu.device is not None else torch.device('cpu')
+        batch = dict()
+        for key, attr in self._batch_keys.items():
+            source = self._tensors[attr]
+            source = source.view(-1, source[0, 0].numel())
+            out = self._output(name, key, (num_tasks, batch_size, source.size(1)), device=device)
+            if source.dtype == out.dtype and out.device == source.device:
+                torch.index_select(source, 0, flat_rows, out=out.view(num_tasks * batch_size, -1))
+            else:
+                # gather in the storage dtype on the host, then convert while copying to the device
+                staging = self._output(name, key, (num_tasks * batch_size, source.size(1)),
+                                       dtype=source.dtype, pin_memory=self._pin_memory)
+                torch.index_select(source, 0, flat_rows, out=staging)
+                out.view(num_tasks * batch_size, -1).copy_(staging)
+            batch[key] = out
+        if 'next_observations' not in batch:
+            next_obs = self.next_observations_multi(tasks, rows)
+            out = self._output(name, 'next_observations', next_obs.shape, device=device)
+            out.copy_(torch.from_numpy(next_obs))
+            batch['next_observations'] = out
+        return batch
+
+    def random_batch_multi_torch(self, tasks, batch_size, sequence=False, name='default', rng=np.random):
+        ''' batches from several tasks as (task, batch, feat) tensors, see sample_data_multi_torch '''
+        rows = self.random_rows_multi(tasks, batch_size, sequence=sequence, rng=rng)
+        return self.sample_data_multi_torch(tasks, rows, name=name)
+
+
+class TorchMultiTaskReplayBufferView(MultiTaskReplayBufferView):
+    '''
+    view over a TorchMultiTaskReplayBuffer that also samples straight into tensors
+    '''
+
+    def random_batch_multi_torch(self, tasks, batch_size, sequence=False, name='default', rng=np.random):
+        rows = self.random_rows_multi(tasks, batch_size, sequence=sequence, rng=rng)
+        return self.replay_buffer.sample_data_multi_torch(tasks, rows, name=name)
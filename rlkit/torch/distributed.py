@@ -0,0 +1,105 @@
+"""
+Data-parallel learner processes that average their gradients with torch.distributed.
+
+Every learner process runs the whole algorithm on its own share of the meta-batch,
+see the learner_shards option of MetaRLAlgorithm. Outside of spawn_learners there is
+no process group and the helpers act as a single learner of rank 0.
+"""
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing
+
+
+def is_available():
+    return hasattr(dist, 'is_available') and dist.is_available()
+
+
+def is_initialized():
+    return is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def shard(items, rank=None, world_size=None):
+    ''' the items of a learner, every world_size-th one starting at its rank '''
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    return list(items)[rank::world_size]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def init_learner(rank, world_size, port, address='127.0.0.1'):
+    '''
+    join the gloo process group of world_size local learners
+    the intra-op threads of the machine are split between the learners
+    '''
+    os.environ['MASTER_ADDR'] = address
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+
+
+def _run_learner(rank, fn, world_size, port, args):
+    init_learner(rank, world_size, port)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn_learners(fn, world_size, *args):
+    ''' run fn(*args) in world_size new processes joined in one process group '''
+    if not is_available():
+        raise RuntimeError("torch.distributed is not available, cannot run {} learners".format(world_size))
+    torch.multiprocessing.spawn(_run_learner, args=(fn, world_size, free_port(), args), nprocs=world_size)
+
+
+def broadcast_object(obj, src=0):
+    ''' obj of learner src on every learner, obj must be picklable '''
+    if not is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def broadcast_parameters(modules, src=0):
+    ''' start every learner from the parameters of learner src '''
+    if not is_initialized():
+        return
+    for module in modules:
+        for param in module.parameters():
+            dist.broadcast(param.data, src=src)
+
+
+def all_reduce_gradients(params):
+    '''
+    average the gradients of params over the learners with one all-reduce
+    learners must pass the same params in the same order, missing gradients count as zero
+    '''
+    params = list(params)
+    if not is_initialized() or len(params) == 0:
+        return
+    flat = torch.cat([
+        (param.grad if param.grad is not None else torch.zeros_like(param)).reshape(-1) for param in params
+    ])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for param in params:
+        param.grad = flat[offset:offset + param.numel()].view_as(param)
+        offset += param.numel()
@@ -3,6 +3,8 @@ General networks for pytorch.
 
 Algorithm-specific networks should go else-where.
 """
+from collections import OrderedDict
+
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
@@ -184,3 +186,97 @@ class RecurrentEncoder(FlattenMlp):
 
 
 
+
+
+class EnsembleLinear(nn.Module):
+    '''
+    ensemble_size independent linear layers applied with one batched matmul
+    weight is (ensemble_size, in, out) and bias (ensemble_size, 1, out)
+    '''
+
+    def __init__(self, ensemble_size, input_size, output_size):
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.input_size = input_size
+        self.output_size = output_size
+        self.weight = nn.Parameter(torch.zeros(ensemble_size, input_size, output_size))
+        self.bias = nn.Parameter(torch.zeros(ensemble_size, 1, output_size))
+
+    def forward(self, input):
+        # input is (ensemble_size, batch, in)
+        return torch.baddbmm(self.bias, input, self.weight)
+
+
+class EnsembleFlattenMlp(PyTorchModule):
+    """
+    ensemble_size FlattenMlps evaluated together, e.g. the twin Q-functions of SAC
+
+    forward concatenates the inputs once and returns (ensemble_size, batch, output_size).
+    Members are initialized like Mlp, and load_mlp_state_dicts converts state dicts of
+    separate Mlps of the same sizes (e.g. qf1.pth and qf2.pth) into the stacked layout.
+    """
+
+    def __init__(
+            self,
+            ensemble_size,
+            hidden_sizes,
+            output_size,
+            input_size,
+            init_w=3e-3,
+            hidden_activation=F.relu,
+            output_activation=identity,
+            hidden_init=ptu.fanin_init,
+            b_init_value=0.1,
+    ):
+        self.save_init_params(locals())
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.input_size = input_size
+        self.output_size = output_size
+        self.hidden_sizes = hidden_sizes
+        self.hidden_activation = hidden_activation
+        self.output_activation = output_activation
+        self.fcs = []
+        in_size = input_size
+
+        for i, next_size in enumerate(hidden_sizes):
+            fc = EnsembleLinear(ensemble_size, in_size, next_size)
+            # initialize each member's (out, in) weight as nn.Linear would hold it
+            weight = torch.zeros(ensemble_size, next_size, in_size)
+            for member in weight:
+                hidden_init(member)
+            fc.weight.data.copy_(weight.transpose(1, 2))
+            fc.bias.data.fill_(b_init_value)
+            in_size = next_size
+            self.__setattr__("fc{}".format(i), fc)
+            self.fcs.append(fc)
+
+        self.last_fc = EnsembleLinear(ensemble_size, in_size, output_size)
+        self.last_fc.weight.data.uniform_(-init_w, init_w)
+        self.last_fc.bias.data.uniform_(-init_w, init_w)
+
+    def forward(self, *inputs):
+        h = torch.cat(inputs, dim=1)
+        h = h.unsqueeze(0).expand(self.ensemble_size, h.size(0), h.size(1))
+        for fc in self.fcs:
+            h = self.hidden_activation(fc(h))
+        return self.output_activation(self.last_fc(h))
+
+    def load_mlp_state_dicts(self, state_dicts):
+        ''' load one Mlp state dict per member, with fc<i> and last_fc layers of matching sizes '''
+        assert len(state_dicts) == self.ensemble_size
+        stacked = dict()
+        for key in self.state_dict():
+            if key.endswith('.weight'):
+                stacked[key] = torch.stack([sd[key].t() for sd in state_dicts])
+            else:
+                stacked[key] = torch.stack([sd[key].unsqueeze(0) for sd in state_dicts])
+        self.load_state_dict(stacked)
+
+    def mlp_state_dicts(self):
+        ''' the inverse of load_mlp_state_dicts, one Mlp state dict per member '''
+        state_dicts = [OrderedDict() for _ in range(self.ensemble_size)]
+        for key, value in self.state_dict().items():
+            for member, sd in enumerate(state_dicts):
+                sd[key] = (value[member].t() if key.endswith('.weight') else value[member, 0]).clone()
+        return state_dicts
@@ -0,0 +1,91 @@
+"""
+One object owning the optimizers of every network an algorithm trains.
+"""
+from collections import OrderedDict
+import inspect
+import time
+
+
+def _multi_tensor_kwargs(optimizer_class):
+    ''' fused, else foreach, for optimizer classes that take them, fastest first '''
+    try:
+        parameters = inspect.signature(optimizer_class.__init__).parameters
+    except (TypeError, ValueError):
+        return [dict()]
+    options = [dict(fused=True)] if 'fused' in parameters else []
+    if 'foreach' in parameters:
+        options.append(dict(foreach=True))
+    return options + [dict()]
+
+
+class OptimizerManager(object):
+    """
+    Named parameter groups, one per network, each with its own learning rate.
+
+    Every group is stepped by its own multi-tensor (fused or foreach) optimizer, since
+    algorithms like SAC step the networks at different points of a training step, and
+    gradients are zeroed by setting them to None. state_dict covers all groups, and the
+    time spent zeroing and stepping is tracked for get_diagnostics.
+    """
+
+    def __init__(self, optimizer_class, groups, reduce_gradients=None, **kwargs):
+        '''
+        :param groups: list of (name, parameters, lr)
+        :param reduce_gradients: called with the parameters of the groups of a step call before
+            stepping them, e.g. to average gradients over learners, see rlkit.torch.distributed
+        :param kwargs: passed to every optimizer
+        '''
+        self.reduce_gradients = reduce_gradients
+        self.optimizers = OrderedDict()
+        for name, params, lr in groups:
+            params = list(params)
+            for multi_tensor_kwargs in _multi_tensor_kwargs(optimizer_class):
+                try:
+                    self.optimizers[name] = optimizer_class(params, lr=lr, **dict(kwargs, **multi_tensor_kwargs))
+                    break
+                except RuntimeError:
+                    # e.g. no fused kernel for the parameters' device
+                    continue
+        self._time = 0.
+        self._reduce_time = 0.
+        self._num_steps = 0
+
+    def parameters(self, *names):
+        return [param for name in names for group in self.optimizers[name].param_groups for param in group['params']]
+
+    def zero_grad(self, *names):
+        start = time.time()
+        for param in self.parameters(*names):
+            param.grad = None
+        self._time += time.time() - start
+
+    def step(self, *names):
+        if self.reduce_gradients is not None:
+            start = time.time()
+            self.reduce_gradients(self.parameters(*names))
+            self._reduce_time += time.time() - start
+        start = time.time()
+        for name in names:
+            self.optimizers[name].step()
+        self._time += time.time() - start
+        self._num_steps += 1
+
+    def state_dict(self):
+        return OrderedDict([(name, optimizer.state_dict()) for name, optimizer in self.optimizers.items()])
+
+    def load_state_dict(self, state_dict):
+        for name, optimizer in self.optimizers.items():
+            optimizer.load_state_dict(state_dict[name])
+
+    def get_diagnostics(self):
+        ''' time spent zeroing, stepping and reducing gradients since the last call, in total and per step call '''
+        stats = OrderedDict([
+            ('Optimizer Time (s)', self._time),
+            ('Optimizer Time per Step Call (ms)', 1000 * self._time / max(self._num_steps, 1)),
+        ])
+        if self.reduce_gradients is not None:
+            stats['Gradient Reduce Time (s)'] = self._reduce_time
+        self._time = 0.
+        self._reduce_time = 0.
+        self._num_steps = 0
+        return stats
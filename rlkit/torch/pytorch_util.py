@@ -4,10 +4,17 @@ import os
 
 
 def soft_update_from_to(source, target, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(
-            target_param.data * (1.0 - tau) + param.data * tau
-        )
+    '''
+    polyak average target <- (1 - tau) * target + tau * source in place, without temporaries
+    uses one multi-tensor lerp where torch has it, else a lerp_ per parameter
+    '''
+    target_params = [param.data for param in target.parameters()]
+    source_params = [param.data for param in source.parameters()]
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(target_params, source_params, tau)
+    else:
+        for target_param, param in zip(target_params, source_params):
+            target_param.lerp_(param, tau)
 
 
 def copy_model_params_from_to(source, target):
@@ -51,7 +58,7 @@ def elem_or_tuple_to_variable(elem_or_tuple):
 
 def filter_batch(np_batch):
     for k, v in np_batch.items():
-        if v.dtype == np.bool:
+        if v.dtype == np.bool_:
             yield k, v.astype(int)
         else:
             yield k, v
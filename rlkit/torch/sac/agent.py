@@ -7,13 +7,13 @@ import torch.nn.functional as F
 import rlkit.torch.pytorch_util as ptu
 
 
-def _product_of_gaussians(mus, sigmas_squared):
+def _product_of_gaussians(mus, sigmas_squared, dim=0):
     '''
-    compute mu, sigma of product of gaussians
+    compute mu, sigma of product of gaussians along dim
     '''
     sigmas_squared = torch.clamp(sigmas_squared, min=1e-7)
-    sigma_squared = 1. / torch.sum(torch.reciprocal(sigmas_squared), dim=0)
-    mu = sigma_squared * torch.sum(mus / sigmas_squared, dim=0)
+    sigma_squared = 1. / torch.sum(torch.reciprocal(sigmas_squared), dim=dim)
+    mu = sigma_squared * torch.sum(mus / sigmas_squared, dim=dim)
     return mu, sigma_squared
 
 
@@ -107,24 +107,21 @@ class PEARLAgent(nn.Module):
             self.context = torch.cat([self.context, data], dim=1)
 
     def compute_kl_div(self):
-        ''' compute KL( q(z|c) || r(z) ) '''
-        prior = torch.distributions.Normal(ptu.zeros(self.latent_dim), ptu.ones(self.latent_dim))
-        posteriors = [torch.distributions.Normal(mu, torch.sqrt(var)) for mu, var in zip(torch.unbind(self.z_means), torch.unbind(self.z_vars))]
-        kl_divs = [torch.distributions.kl.kl_divergence(post, prior) for post in posteriors]
-        kl_div_sum = torch.sum(torch.stack(kl_divs))
-        return kl_div_sum
+        ''' compute KL( q(z|c) || r(z) ) summed over tasks, in closed form for a unit gaussian prior '''
+        kl_divs = 0.5 * (self.z_vars + self.z_means ** 2 - 1. - torch.log(self.z_vars))
+        return torch.sum(kl_divs)
 
     def infer_posterior(self, context):
         ''' compute q(z|c) as a function of input context and sample new z from it'''
-        params = self.context_encoder(context)
+        # the posterior is computed in float32, also when the encoder runs under autocast
+        params = self.context_encoder(context).float()
         params = params.view(context.size(0), -1, self.context_encoder.output_size)
         # with probabilistic z, predict mean and variance of q(z | c)
         if self.use_ib:
             mu = params[..., :self.latent_dim]
             sigma_squared = F.softplus(params[..., self.latent_dim:])
-            z_params = [_product_of_gaussians(m, s) for m, s in zip(torch.unbind(mu), torch.unbind(sigma_squared))]
-            self.z_means = torch.stack([p[0] for p in z_params])
-            self.z_vars = torch.stack([p[1] for p in z_params])
+            # product over the context of each task
+            self.z_means, self.z_vars = _product_of_gaussians(mu, sigma_squared, dim=1)
         # sum rather than product of gaussians structure
         else:
             self.z_means = torch.mean(params, dim=1)
@@ -132,9 +129,8 @@ class PEARLAgent(nn.Module):
 
     def sample_z(self):
         if self.use_ib:
-            posteriors = [torch.distributions.Normal(m, torch.sqrt(s)) for m, s in zip(torch.unbind(self.z_means), torch.unbind(self.z_vars))]
-            z = [d.rsample() for d in posteriors]
-            self.z = torch.stack(z)
+            # reparameterized sample for all tasks at once
+            self.z = self.z_means + torch.sqrt(self.z_vars) * torch.randn_like(self.z_means)
         else:
             self.z = self.z_means
 
@@ -157,8 +153,7 @@ class PEARLAgent(nn.Module):
 
         t, b, _ = obs.size()
         obs = obs.view(t * b, -1)
-        task_z = [z.repeat(b, 1) for z in task_z]
-        task_z = torch.cat(task_z, dim=0)
+        task_z = task_z.unsqueeze(1).expand(t, b, task_z.size(1)).reshape(t * b, -1)
 
         # run policy, get log probs and new actions
         in_ = torch.cat([obs, task_z.detach()], dim=1)
@@ -11,6 +11,8 @@ from rlkit.torch.core import np_ify
 
 LOG_SIG_MAX = 2
 LOG_SIG_MIN = -20
+# keeps the log-probability of actions at the tanh bounds finite
+TANH_EPSILON = 1e-6
 
 
 class TanhGaussianPolicy(Mlp, ExplorationPolicy):
@@ -87,9 +89,10 @@ class TanhGaussianPolicy(Mlp, ExplorationPolicy):
         h = obs
         for i, fc in enumerate(self.fcs):
             h = self.hidden_activation(fc(h))
-        mean = self.last_fc(h)
+        # the tanh-gaussian is computed in float32, also when the layers run under autocast
+        mean = self.last_fc(h).float()
         if self.std is None:
-            log_std = self.last_fc_log_std(h)
+            log_std = self.last_fc_log_std(h).float()
             log_std = torch.clamp(log_std, LOG_SIG_MIN, LOG_SIG_MAX)
             std = torch.exp(log_std)
         else:
@@ -102,8 +105,19 @@ class TanhGaussianPolicy(Mlp, ExplorationPolicy):
         pre_tanh_value = None
         if deterministic:
             action = torch.tanh(mean)
+        elif reparameterize and return_log_prob:
+            # the training path, written in tensor ops only so a compiled forward has no graph breaks
+            # same as TanhNormal.rsample and log_prob, (pre_tanh_value - mean) / std is the noise
+            noise = torch.randn_like(mean)
+            pre_tanh_value = mean + std * noise
+            action = torch.tanh(pre_tanh_value)
+            log_prob = (
+                -0.5 * noise ** 2 - log_std - 0.5 * np.log(2 * np.pi)
+                - torch.log(1 - action * action + TANH_EPSILON)
+            )
+            log_prob = log_prob.sum(dim=1, keepdim=True)
         else:
-            tanh_normal = TanhNormal(mean, std)
+            tanh_normal = TanhNormal(mean, std, epsilon=TANH_EPSILON)
             if return_log_prob:
                 if reparameterize:
                     action, pre_tanh_value = tanh_normal.rsample(
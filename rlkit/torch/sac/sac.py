@@ -1,4 +1,7 @@
 from collections import OrderedDict
+import contextlib
+import time
+
 import numpy as np
 
 import torch
@@ -6,8 +9,13 @@ import torch.optim as optim
 from torch import nn as nn
 
 import rlkit.torch.pytorch_util as ptu
+from rlkit.core import logger
 from rlkit.core.eval_util import create_stats_ordered_dict
 from rlkit.core.rl_algorithm import MetaRLAlgorithm
+from rlkit.data_management.simple_replay_buffer import env_info_schema
+from rlkit.torch import distributed
+from rlkit.torch.compile import can_compile, compile_forward, uncompile_forward, time_calls
+from rlkit.torch.optimizers import OptimizerManager
 
 
 class PEARLSoftActorCritic(MetaRLAlgorithm):
@@ -31,12 +39,23 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
             recurrent=False,
             use_information_bottleneck=True,
             sparse_rewards=False,
+            ensemble_critic=False,
+            num_critics=2,
+            compile=False,
+            precision='float32',
 
             soft_target_tau=1e-2,
             plotter=None,
             render_eval_paths=False,
             **kwargs
     ):
+        if sparse_rewards:
+            # the encoder is trained on the sparse reward the env reports in env_info, so it needs a buffer column
+            env_info_keys = kwargs.get('env_info_keys')
+            if env_info_keys is None:
+                env_info_keys = getattr(env, 'env_info_keys', None)
+            kwargs['env_info_keys'] = env_info_schema(env_info_keys)
+            kwargs['env_info_keys'].setdefault('sparse_reward', 1)
         super().__init__(
             env=env,
             agent=nets[0],
@@ -63,34 +82,134 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
         self.use_information_bottleneck = use_information_bottleneck
         self.sparse_rewards = sparse_rewards
 
-        self.qf1, self.qf2, self.vf = nets[1:]
+        # nets hold either one EnsembleFlattenMlp of num_critics Q-functions or separate qf1 and qf2
+        self.ensemble_critic = ensemble_critic
+        if ensemble_critic:
+            self.qf, self.vf = nets[1:]
+            assert self.qf.ensemble_size == num_critics
+        else:
+            if num_critics != 2:
+                raise ValueError("num_critics other than 2 needs ensemble_critic")
+            self.qf1, self.qf2, self.vf = nets[1:]
         self.target_vf = self.vf.copy()
-
-        self.policy_optimizer = optimizer_class(
-            self.agent.policy.parameters(),
-            lr=policy_lr,
-        )
-        self.qf1_optimizer = optimizer_class(
-            self.qf1.parameters(),
-            lr=qf_lr,
-        )
-        self.qf2_optimizer = optimizer_class(
-            self.qf2.parameters(),
-            lr=qf_lr,
-        )
-        self.vf_optimizer = optimizer_class(
-            self.vf.parameters(),
-            lr=vf_lr,
-        )
-        self.context_optimizer = optimizer_class(
-            self.agent.context_encoder.parameters(),
-            lr=context_lr,
-        )
+        self.compile = compile
+        if precision not in ['float32', 'bfloat16']:
+            raise ValueError("Unknown precision: {}".format(precision))
+        if precision == 'bfloat16' and not hasattr(torch, 'autocast'):
+            logger.log('torch has no autocast, training in float32')
+            precision = 'float32'
+        self.precision = precision
+        self._compile_statistics = OrderedDict()
+
+        # one optimizer per network with its own learning rate, see OptimizerManager
+        # several learners average their gradients before every step
+        reduce_gradients = distributed.all_reduce_gradients if self.num_learners > 1 else None
+        self.optimizers = OptimizerManager(optimizer_class, [
+            ('policy', self.agent.policy.parameters(), policy_lr),
+        ] + [
+            (name, qf.parameters(), qf_lr) for name, qf in self.named_qfs
+        ] + [
+            ('vf', self.vf.parameters(), vf_lr),
+            ('context', self.agent.context_encoder.parameters(), context_lr),
+        ], reduce_gradients=reduce_gradients)
 
     ###### Torch stuff #####
+    @property
+    def named_qfs(self):
+        ''' (name, module) of the Q-functions, one ensemble or qf1 and qf2 '''
+        return [('qf', self.qf)] if self.ensemble_critic else [('qf1', self.qf1), ('qf2', self.qf2)]
+
+    @property
+    def qfs(self):
+        return [qf for _, qf in self.named_qfs]
+
     @property
     def networks(self):
-        return self.agent.networks + [self.agent] + [self.qf1, self.qf2, self.vf, self.target_vf]
+        return self.agent.networks + [self.agent] + self.qfs + [self.vf, self.target_vf]
+
+    def pretrain(self):
+        if self.compile:
+            self._compile_networks()
+
+    def _compile_networks(self, num_timed_calls=10):
+        '''
+        compile the forwards of the agent, critic and value networks and warm them up on
+        inputs of training shapes, timing forward-backward passes before and after
+        networks stay eager if torch has no torch.compile or compilation fails
+        '''
+        if not can_compile():
+            logger.log('torch.compile is not available, networks stay eager')
+            return
+        nets = [self.agent.policy, self.agent.context_encoder] + self.qfs + [self.vf, self.target_vf]
+        inputs = self._warmup_inputs()
+        try:
+            eager_time = time_calls(lambda: self._warmup_pass(*inputs), num_timed_calls)
+            for net in nets:
+                compile_forward(net)
+            start = time.time()
+            # the first pass compiles
+            self._warmup_pass(*inputs)
+            warmup_time = time.time() - start
+            compiled_time = time_calls(lambda: self._warmup_pass(*inputs), num_timed_calls)
+        except Exception as e:
+            logger.log('compiling networks failed, they stay eager: {}'.format(e))
+            for net in nets:
+                uncompile_forward(net)
+            return
+        finally:
+            # back to the prior of a single task, as before the warmup
+            self.agent.clear_z()
+        self._compile_statistics = OrderedDict([
+            ('Compile Warmup Time (s)', warmup_time),
+            ('Eager Step Time (ms)', eager_time * 1000),
+            ('Compiled Step Time (ms)', compiled_time * 1000),
+        ])
+        logger.log('compiled networks in {:.1f}s, forward-backward {:.2f}ms eager vs {:.2f}ms compiled'.format(
+            warmup_time, eager_time * 1000, compiled_time * 1000))
+
+    def _warmup_inputs(self):
+        ''' random inputs with the shapes of a training step '''
+        num_rows = self.meta_batch * self.batch_size
+        obs_dim = self.vf.input_size - self.latent_dim
+        action_dim = self.agent.policy.output_size
+        return (
+            ptu.randn(num_rows, obs_dim),
+            ptu.randn(num_rows, action_dim),
+            ptu.randn(num_rows, self.latent_dim),
+            ptu.randn(self.meta_batch, self.embedding_mini_batch_size, self.agent.context_encoder.input_size),
+        )
+
+    def _warmup_pass(self, obs, actions, task_z, context):
+        '''
+        forward and backward through every network like _take_step, without updating them
+        forwards run under _autocast, so graphs are compiled and timed in the training precision
+        '''
+        # fresh encoder state for meta_batch tasks, like every _do_training call
+        self.agent.clear_z(num_tasks=self.meta_batch)
+        with self._autocast():
+            encoder_out = self.agent.context_encoder(context).float()
+            policy_outputs = self.agent.policy(torch.cat([obs, task_z], dim=1), reparameterize=True, return_log_prob=True)
+            min_q = self._min_q(obs, policy_outputs[0], task_z).float()
+            q_preds = self._q_values(obs, actions, task_z).float()
+            v_pred = self.vf(obs, task_z).float()
+            with torch.no_grad():
+                self.target_vf(obs, task_z)
+        encoder_out.sum().backward()
+        loss = q_preds.sum() + v_pred.sum() + (policy_outputs[3] - min_q).sum()
+        loss.backward()
+        for net in self.networks:
+            net.zero_grad()
+
+    def _autocast(self):
+        '''
+        context running network forwards in bfloat16 when precision is 'bfloat16'
+        parameters, and so the optimizers' weights and state, stay float32, and so do losses
+        computed from the .float() outputs
+        '''
+        if self.precision == 'bfloat16':
+            device_type = ptu.device.type if ptu.device is not None else 'cpu'
+            return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+        return contextlib.ExitStack()
 
     def training_mode(self, mode):
         for net in self.networks:
@@ -103,34 +222,43 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
             net.to(device)
 
     ##### Data handling #####
-    def sample_data(self, indices, encoder=False):
-        ''' sample data from replay buffers to construct a training meta-batch '''
-        # collect data from multiple tasks for the meta-batch
-        obs, actions, rewards, next_obs, terms = [], [], [], [], []
-        for idx in indices:
-            if encoder:
-                batch = ptu.np_to_pytorch_batch(self.enc_replay_buffer.random_batch(idx, batch_size=self.embedding_batch_size, sequence=self.recurrent))
-            else:
-                batch = ptu.np_to_pytorch_batch(self.replay_buffer.random_batch(idx, batch_size=self.batch_size))
-            o = batch['observations'][None, ...]
-            a = batch['actions'][None, ...]
-            if encoder and self.sparse_rewards:
-                # in sparse reward settings, only the encoder is trained with sparse reward
-                r = batch['sparse_rewards'][None, ...]
-            else:
-                r = batch['rewards'][None, ...]
-            no = batch['next_observations'][None, ...]
-            t = batch['terminals'][None, ...]
-            obs.append(o)
-            actions.append(a)
-            rewards.append(r)
-            next_obs.append(no)
-            terms.append(t)
-        obs = torch.cat(obs, dim=0)
-        actions = torch.cat(actions, dim=0)
-        rewards = torch.cat(rewards, dim=0)
-        next_obs = torch.cat(next_obs, dim=0)
-        terms = torch.cat(terms, dim=0)
+    def sample_rows(self, indices, encoder=False, uniform=None):
+        '''
+        (task, batch) storage rows of a training meta-batch
+        :param uniform: (task, batch) draws in [0, 1) selecting the transitions, see SamplingPlan,
+            drawn from the global RNG if None
+        '''
+        batch_size = self.embedding_batch_size if encoder else self.batch_size
+        if uniform is None:
+            uniform = np.random.random_sample((len(indices), batch_size))
+        buffer = self.enc_replay_buffer if encoder else self.replay_buffer
+        return buffer.rows_from_uniform_multi(indices, uniform, sequence=encoder and self.recurrent)
+
+    def sample_data(self, indices, encoder=False, uniform=None, reuse=True, rows=None):
+        '''
+        sample data from replay buffers to construct a training meta-batch
+        :param uniform: draws selecting the transitions, see sample_rows
+        :param reuse: allow sampling into the reused tensors of a torch-native buffer,
+            batches that must outlive the next sample (e.g. prefetched ones) are newly allocated
+        :param rows: storage rows to gather instead of drawing them
+        '''
+        # collect data from multiple tasks for the meta-batch, stacked as (task, batch, feat)
+        if rows is None:
+            rows = self.sample_rows(indices, encoder=encoder, uniform=uniform)
+        if reuse and hasattr(self.replay_buffer, 'sample_data_multi_torch'):
+            # torch-native buffer, tensors are reused so each name's batch lives until its next sample
+            batch = self.replay_buffer.sample_data_multi_torch(indices, rows, name='encoder' if encoder else 'rl')
+        else:
+            batch = ptu.np_to_pytorch_batch(self.replay_buffer.sample_data_multi(indices, rows))
+        obs = batch['observations']
+        actions = batch['actions']
+        if encoder and self.sparse_rewards:
+            # in sparse reward settings, only the encoder is trained with sparse reward
+            rewards = batch['sparse_reward']
+        else:
+            rewards = batch['rewards']
+        next_obs = batch['next_observations']
+        terms = batch['terminals']
         return [obs, actions, rewards, next_obs, terms]
 
     def prepare_encoder_data(self, obs, act, rewards):
@@ -142,50 +270,90 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
 
     def prepare_context(self, idx):
         ''' sample context from replay buffer and prepare it '''
-        batch = ptu.np_to_pytorch_batch(self.enc_replay_buffer.random_batch(idx, batch_size=self.embedding_batch_size, sequence=self.recurrent))
-        obs = batch['observations'][None, ...]
-        act = batch['actions'][None, ...]
-        rewards = batch['rewards'][None, ...]
+        if hasattr(self.enc_replay_buffer, 'random_batch_multi_torch'):
+            # torch-native buffer, sampled straight into (1, batch, feat) tensors that are reused,
+            # which is safe as prepare_encoder_data copies them into a new context
+            batch = self.enc_replay_buffer.random_batch_multi_torch(
+                [idx], self.embedding_batch_size, sequence=self.recurrent, name='context')
+            obs, act, rewards = batch['observations'], batch['actions'], batch['rewards']
+        else:
+            batch = ptu.np_to_pytorch_batch(self.enc_replay_buffer.random_batch(idx, batch_size=self.embedding_batch_size, sequence=self.recurrent))
+            obs = batch['observations'][None, ...]
+            act = batch['actions'][None, ...]
+            rewards = batch['rewards'][None, ...]
         context = self.prepare_encoder_data(obs, act, rewards)
         return context
 
     ##### Training #####
-    def _do_training(self, indices):
+    def training_draw_shapes(self):
+        ''' draws of the context batch and the RL batch of every update in one _do_training call '''
+        num_updates = self.embedding_batch_size // self.embedding_mini_batch_size
+        return OrderedDict([
+            ('encoder', (self.meta_batch, self.embedding_batch_size)),
+            ('rl', (num_updates, self.meta_batch, self.batch_size)),
+        ])
+
+    def sample_training_batches(self, indices, draws, reuse=False):
+        '''
+        context batch and the RL batch of every update of one _do_training call
+        with reuse the RL batches share tensors, so they are sampled lazily as the updates consume them
+        '''
+        enc_batch = self.sample_data(indices, encoder=True, uniform=draws['encoder'], reuse=reuse)
+        rl_batches = (self._sample_rl_batch(indices, uniform, reuse) for uniform in draws['rl'])
+        if not reuse:
+            rl_batches = list(rl_batches)
+        return enc_batch, rl_batches
+
+    def _sample_rl_batch(self, indices, uniform, reuse):
+        ''' RL batch and its storage rows, whose priorities are updated after the step '''
+        rows = self.sample_rows(indices, uniform=uniform)
+        return self.sample_data(indices, reuse=reuse, rows=rows), rows
+
+    def _do_training(self, indices, batches):
         mb_size = self.embedding_mini_batch_size
         num_updates = self.embedding_batch_size // mb_size
 
-        batch = self.sample_data(indices, encoder=True)
+        batch, rl_batches = batches
 
         # zero out context and hidden encoder state
         self.agent.clear_z(num_tasks=len(indices))
 
-        for i in range(num_updates):
+        for i, (rl_batch, rl_rows) in zip(range(num_updates), rl_batches):
             mini_batch = [x[:, i * mb_size: i * mb_size + mb_size, :] for x in batch]
             obs_enc, act_enc, rewards_enc, _, _ = mini_batch
             context = self.prepare_encoder_data(obs_enc, act_enc, rewards_enc)
-            self._take_step(indices, context)
+            self._take_step(indices, context, rl_batch, rl_rows)
 
             # stop backprop
             self.agent.detach_z()
 
+    def _q_values(self, obs, actions, task_z):
+        ''' (critic, batch, 1) predictions of every Q-function '''
+        if self.ensemble_critic:
+            return self.qf(obs, actions, task_z)
+        return torch.stack([self.qf1(obs, actions, task_z), self.qf2(obs, actions, task_z)])
+
     def _min_q(self, obs, actions, task_z):
-        q1 = self.qf1(obs, actions, task_z.detach())
-        q2 = self.qf2(obs, actions, task_z.detach())
-        min_q = torch.min(q1, q2)
+        q_values = self._q_values(obs, actions, task_z.detach())
+        min_q = torch.min(q_values, dim=0)[0]
         return min_q
 
     def _update_target_network(self):
         ptu.soft_update_from_to(self.vf, self.target_vf, self.soft_target_tau)
 
-    def _take_step(self, indices, context):
+    def _take_step(self, indices, context, batch=None, rows=None):
 
         num_tasks = len(indices)
 
         # data is (task, batch, feat)
-        obs, actions, rewards, next_obs, terms = self.sample_data(indices)
+        if batch is None:
+            rows = self.sample_rows(indices)
+            batch = self.sample_data(indices, rows=rows)
+        obs, actions, rewards, next_obs, terms = batch
 
         # run inference in networks
-        policy_outputs, task_z = self.agent(obs, context)
+        with self._autocast():
+            policy_outputs, task_z = self.agent(obs, context)
         new_actions, policy_mean, policy_log_std, log_pi = policy_outputs[:4]
 
         # flattens out the task dimension
@@ -196,43 +364,52 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
 
         # Q and V networks
         # encoder will only get gradients from Q nets
-        q1_pred = self.qf1(obs, actions, task_z)
-        q2_pred = self.qf2(obs, actions, task_z)
-        v_pred = self.vf(obs, task_z.detach())
-        # get targets for use in V and Q updates
-        with torch.no_grad():
-            target_v_values = self.target_vf(next_obs, task_z)
+        with self._autocast():
+            q_preds = self._q_values(obs, actions, task_z).float()
+            v_pred = self.vf(obs, task_z.detach()).float()
+            # get targets for use in V and Q updates
+            with torch.no_grad():
+                target_v_values = self.target_vf(next_obs, task_z).float()
 
         # KL constraint on z if probabilistic
-        self.context_optimizer.zero_grad()
+        self.optimizers.zero_grad('context')
         if self.use_information_bottleneck:
             kl_div = self.agent.compute_kl_div()
             kl_loss = self.kl_lambda * kl_div
-            kl_loss.backward(retain_graph=True)
+            # the KL is summed over tasks while the other losses are means, so it is scaled
+            # up for the gradients averaged over learners to match a single learner's
+            (kl_loss * self.num_learners).backward(retain_graph=True)
 
         # qf and encoder update (note encoder does not get grads from policy or vf)
-        self.qf1_optimizer.zero_grad()
-        self.qf2_optimizer.zero_grad()
+        self.optimizers.zero_grad(*[name for name, _ in self.named_qfs])
         rewards_flat = rewards.view(self.batch_size * num_tasks, -1)
         # scale rewards for Bellman update
         rewards_flat = rewards_flat * self.reward_scale
         terms_flat = terms.view(self.batch_size * num_tasks, -1)
         q_target = rewards_flat + (1. - terms_flat) * self.discount * target_v_values
-        qf_loss = torch.mean((q1_pred - q_target) ** 2) + torch.mean((q2_pred - q_target) ** 2)
+        if self.prioritized_replay:
+            # importance weights correct the Q losses for sampling by priority
+            weights = ptu.from_numpy(self.replay_buffer.importance_weights_multi(
+                indices, rows, self.priority_beta)).view(-1, 1)
+            qf_loss = (weights * (q_preds - q_target) ** 2).view(q_preds.size(0), -1).mean(dim=1).sum()
+        else:
+            qf_loss = ((q_preds - q_target) ** 2).view(q_preds.size(0), -1).mean(dim=1).sum()
         qf_loss.backward()
-        self.qf1_optimizer.step()
-        self.qf2_optimizer.step()
-        self.context_optimizer.step()
+        self.optimizers.step(*[name for name, _ in self.named_qfs] + ['context'])
+        if self.prioritized_replay:
+            td_errors = ptu.get_numpy(q_preds[0] - q_target).reshape(num_tasks, -1)
+            self.update_priorities(indices, rows, td_errors)
 
         # compute min Q on the new actions
-        min_q_new_actions = self._min_q(obs, new_actions, task_z)
+        with self._autocast():
+            min_q_new_actions = self._min_q(obs, new_actions, task_z).float()
 
         # vf update
         v_target = min_q_new_actions - log_pi
         vf_loss = self.vf_criterion(v_pred, v_target.detach())
-        self.vf_optimizer.zero_grad()
+        self.optimizers.zero_grad('vf')
         vf_loss.backward()
-        self.vf_optimizer.step()
+        self.optimizers.step('vf')
         self._update_target_network()
 
         # policy update
@@ -252,15 +429,16 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
         policy_reg_loss = mean_reg_loss + std_reg_loss + pre_activation_reg_loss
         policy_loss = policy_loss + policy_reg_loss
 
-        self.policy_optimizer.zero_grad()
+        self.optimizers.zero_grad('policy')
         policy_loss.backward()
-        self.policy_optimizer.step()
+        self.optimizers.step('policy')
 
         # save some statistics for eval
         if self.eval_statistics is None:
             # eval should set this to None.
             # this way, these statistics are only computed for one batch.
             self.eval_statistics = OrderedDict()
+            self.eval_statistics.update(self._compile_statistics)
             if self.use_information_bottleneck:
                 z_mean = np.mean(np.abs(ptu.get_numpy(self.agent.z_means[0])))
                 z_sig = np.mean(ptu.get_numpy(self.agent.z_vars[0]))
@@ -276,7 +454,7 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
             ))
             self.eval_statistics.update(create_stats_ordered_dict(
                 'Q Predictions',
-                ptu.get_numpy(q1_pred),
+                ptu.get_numpy(q_preds[0]),
             ))
             self.eval_statistics.update(create_stats_ordered_dict(
                 'V Predictions',
@@ -295,14 +473,19 @@ class PEARLSoftActorCritic(MetaRLAlgorithm):
                 ptu.get_numpy(policy_log_std),
             ))
 
+    def get_training_diagnostics(self):
+        return self.optimizers.get_diagnostics()
+
     def get_epoch_snapshot(self, epoch):
         # NOTE: overriding parent method which also optionally saves the env
+        # an ensemble critic is saved as separate Q-functions qf1, qf2, ... like the default critics
+        qf_state_dicts = self.qf.mlp_state_dicts() if self.ensemble_critic else [qf.state_dict() for qf in self.qfs]
         snapshot = OrderedDict(
-            qf1=self.qf1.state_dict(),
-            qf2=self.qf2.state_dict(),
+            [('qf{}'.format(i + 1), state_dict) for i, state_dict in enumerate(qf_state_dicts)],
             policy=self.agent.policy.state_dict(),
             vf=self.vf.state_dict(),
             target_vf=self.target_vf.state_dict(),
             context_encoder=self.agent.context_encoder.state_dict(),
+            optimizers=self.optimizers.state_dict(),
         )
         return snapshot
@@ -0,0 +1,104 @@
+import copy
+
+import numpy as np
+import pytest
+from gym.spaces import Box
+
+from rlkit.data_management.env_replay_buffer import MultiTaskReplayBuffer, MultiTaskReplayBufferView
+
+
+class BoxEnv(object):
+    observation_space = Box(-1., 1., (2,), dtype=np.float32)
+    action_space = Box(-1., 1., (1,), dtype=np.float32)
+
+
+def make_paths(num_paths, length):
+    return [dict(
+        observations=np.random.randn(length, 2),
+        next_observations=np.random.randn(length, 2),
+        actions=np.random.randn(length, 1),
+        rewards=np.random.randn(length, 1),
+        terminals=np.zeros((length, 1)),
+        env_infos=[{}] * length,
+        agent_infos=[{}] * length,
+    ) for _ in range(num_paths)]
+
+
+def check_view(buffer, view, referenced):
+    ''' every range added to the view since it was last cleared is live '''
+    for task, ranges in referenced.items():
+        assert view.num_steps_can_sample(task) == sum(length for _, length in ranges)
+        oldest = buffer.task_buffers[task].oldest_absolute_row()
+        assert all(start >= oldest for start, _ in ranges)
+
+
+@pytest.mark.parametrize('eviction_policy', ['oldest', 'quota'])
+def test_budget_eviction(eviction_policy):
+    np.random.seed(0)
+    tasks, budget, quota = list(range(4)), 250, 40
+    buffer = MultiTaskReplayBuffer(1000, BoxEnv(), tasks, global_budget=budget,
+                                   eviction_policy=eviction_policy, min_task_quota=quota)
+    view = MultiTaskReplayBufferView(buffer)
+    referenced = dict([(task, []) for task in tasks])
+    written = dict([(task, 0) for task in tasks])
+
+    def collect(task, num_paths, add_to_view=True):
+        ranges = buffer.add_paths(task, make_paths(num_paths, 10))
+        written[task] += num_paths * 10
+        if add_to_view:
+            view.add_ranges(task, ranges)
+            referenced[task] += ranges
+        check_view(buffer, view, referenced)
+        if eviction_policy == 'quota':
+            # tasks are never evicted below the quota once they reached it
+            assert all(size >= min(quota, written[t]) for t, size in buffer.task_sizes().items())
+
+    # initial pool, referenced by the view until a task is sampled again
+    for task in tasks:
+        collect(task, 5)
+    # the last task is never sampled again and its rows are no longer referenced,
+    # oldest first would evict all of them
+    view.clear_buffer(tasks[-1])
+    referenced[tasks[-1]] = []
+    for _ in range(20):
+        task = np.random.randint(len(tasks) - 1)
+        view.clear_buffer(task)
+        referenced[task] = []
+        collect(task, 2)
+        collect(task, 2, add_to_view=False)
+
+    # once the view references no rows, a write brings the buffer back within the budget
+    for task in tasks:
+        view.clear_buffer(task)
+        referenced[task] = []
+    collect(0, 1, add_to_view=False)
+    assert sum(buffer.task_sizes().values()) <= budget
+    if eviction_policy == 'quota':
+        assert min(buffer.task_sizes().values()) >= quota
+
+
+def tiny_variant(log_dir, **algo_params):
+    from configs.default import default_config
+    variant = copy.deepcopy(default_config)
+    variant['env_name'] = 'point-robot'
+    variant['env_params'] = dict(n_tasks=6, randomize_tasks=True)
+    variant['n_train_tasks'] = 4
+    variant['n_eval_tasks'] = 2
+    variant['net_size'] = 32
+    variant['algo_params'].update(dict(
+        num_iterations=3, num_initial_steps=100, num_tasks_sample=2, num_steps_prior=40,
+        num_extra_rl_steps_posterior=40, num_train_steps_per_itr=5, num_evals=1,
+        num_steps_per_eval=40, batch_size=16, embedding_batch_size=8,
+        embedding_mini_batch_size=8, max_path_length=20, meta_batch=3,
+    ))
+    variant['algo_params'].update(algo_params)
+    variant['util_params'].update(use_gpu=False, base_log_dir=str(log_dir))
+    return variant
+
+
+@pytest.mark.parametrize('eviction_policy', ['oldest', 'quota'])
+def test_training_with_budget(tmp_path, eviction_policy):
+    import launch_experiment
+    # the initial pool alone is over the budget, rows the encoder buffer references must survive eviction
+    launch_experiment.experiment(tiny_variant(
+        tmp_path, replay_buffer_budget=250, eviction_policy=eviction_policy, min_task_quota=40))